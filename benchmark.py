@@ -0,0 +1,221 @@
+"""
+This software comes as Open Source and licensed via AGPL v3.
+It was developed under the initiative Copernicus, EFAS operational center @ECMWF (Reading, UK).
+
+Benchmarks of intertable builds and applications on synthetic grids (no GRIB data needed).
+Source grids (regular_ll, regular_gg, octahedral reduced_gg, rotated_ll, see grib_interpolator.synthetic)
+and regular target grids are generated in memory.
+Each case runs in its own process, so peak memory (max RSS) is measured per case.
+Results are written as JSON, to be compared between commits:
+
+    python benchmark.py --size small --output before.json
+    python benchmark.py --size small --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import Queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy
+
+from grib_interpolator.base import Interpolator
+from grib_interpolator.intertables import intertables_cache, save_intertable, load_intertable
+from grib_interpolator.scipylib import InverseDistance, clear_trees
+from grib_interpolator.synthetic import regular_grid, rotated_grid, gaussian_grid, octahedral_grid
+
+SOUTH_POLE = (-40., 10.)
+
+# source grids and target (ny, nx) shapes of each benchmark size
+SIZES = {
+    'small': {'sources': (('regular_ll', (181, 360)), ('regular_gg', 48), ('reduced_gg', 48),
+                          ('rotated_ll', (101, 101))),
+              'targets': ((50, 50), (200, 200))},
+    'medium': {'sources': (('regular_ll', (721, 1440)), ('regular_gg', 320), ('reduced_gg', 320),
+                           ('rotated_ll', (501, 501))),
+               'targets': ((500, 500), (1000, 1000))},
+    'large': {'sources': (('regular_ll', (1441, 2880)), ('regular_gg', 640), ('reduced_gg', 1280),
+                          ('rotated_ll', (1001, 1001))),
+              'targets': ((1000, 1000), (2000, 2000))},
+}
+METHODS = ('scipy_nearest', 'scipy_invdist', 'analytic_nearest', 'analytic_invdist')
+NUM_FIELDS = 10
+# seconds between checks that the process of a case is still alive
+POLL_SECONDS = 1.
+
+
+def source_grid(grid_type, size):
+    if grid_type == 'regular_ll':
+        nj, ni = size
+        return regular_grid(90., -90., nj, 0., 360. - 360. / ni, ni)
+    elif grid_type == 'regular_gg':
+        return gaussian_grid(size)
+    elif grid_type == 'reduced_gg':
+        return octahedral_grid(size)
+    elif grid_type == 'rotated_ll':
+        nj, ni = size
+        return rotated_grid(25., -25., nj, -25., 25., ni, *SOUTH_POLE)
+    raise ValueError('Unknown grid type {}'.format(grid_type))
+
+
+def target_grid(shape):
+    # regular grid over Europe
+    ny, nx = shape
+    lons, lats = np.meshgrid(np.linspace(-10, 30, nx), np.linspace(65, 35, ny))
+    return lats, lons
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.timings = []
+
+    def time(self, phase, points, function, *args, **kwargs):
+        started = time.time()
+        result = function(*args, **kwargs)
+        seconds = time.time() - started
+        self.timings.append({'phase': phase, 'seconds': seconds, 'points': points,
+                             'throughput': points / seconds if seconds > 0 else None})
+        return result
+
+
+def _run_case(grid_type, size, target_shape, method, repeat):
+    grid = source_grid(grid_type, size)
+    target_lats, target_lons = target_grid(target_shape)
+    values = np.random.RandomState(0).rand(NUM_FIELDS, grid.lats.size)
+    num_target = target_lats.size
+    timer = Timer()
+    store = tempfile.mkdtemp()
+    try:
+        clear_trees()
+        intertables_cache.clear()
+        if method.startswith('scipy'):
+            nnear = 4 if method.endswith('invdist') else 1
+            scipy_interpolator = timer.time('kdtree', grid.lats.size, InverseDistance, grid.lons, grid.lats, grid,
+                                            nnear, np.nan, np.nan)
+            timer.time('query', num_target, scipy_interpolator.interpolate, values[0], target_lons, target_lats)
+            clear_trees()
+        _, mode = method.split('_')
+        interpolator = Interpolator(grid.lats, grid.lons, grid, method=method.split('_')[0], mode=mode,
+                                    store=store, masked=False)
+        timer.time('create', num_target, interpolator.interpolate, values[0], target_lons, target_lats)
+        intertable = intertables_cache.get(interpolator.intertable_path)
+        path = os.path.join(store, 'copy.itab')
+        timer.time('save', num_target, save_intertable, path, intertable)
+        timer.time('load', num_target, load_intertable, path, mmap=False)
+        for _ in xrange(repeat):
+            timer.time('apply', num_target, interpolator.interpolate, values[0], target_lons, target_lats)
+            timer.time('apply_many', num_target * NUM_FIELDS, interpolator.interpolate_many,
+                       values, target_lons, target_lats)
+    finally:
+        shutil.rmtree(store)
+    # ru_maxrss is in KB on Linux
+    return timer.timings, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _case_process(queue, args):
+    try:
+        queue.put(('ok', _run_case(*args)))
+    except Exception as e:
+        queue.put(('error', '{}: {}'.format(type(e).__name__, e)))
+
+
+def run_case(*args):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_case_process, args=(queue, args))
+    process.start()
+    while True:
+        try:
+            status, result = queue.get(timeout=POLL_SECONDS)
+            break
+        except Queue.Empty:
+            if process.is_alive():
+                continue
+            # the child died without a result (e.g. killed by the OOM killer or a segfault),
+            # unless the result was still on its way when it exited
+            try:
+                status, result = queue.get(timeout=POLL_SECONDS)
+                break
+            except Queue.Empty:
+                process.join()
+                return 'error', 'exit code {}'.format(process.exitcode)
+    process.join()
+    return status, result
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(size, methods, repeat):
+    results = []
+    for grid_type, grid_size in SIZES[size]['sources']:
+        for target_shape in SIZES[size]['targets']:
+            for method in methods:
+                case = {'grid_type': grid_type, 'grid_size': grid_size, 'target_shape': list(target_shape),
+                        'method': method}
+                status, result = run_case(grid_type, grid_size, target_shape, method, repeat)
+                if status == 'ok':
+                    timings, peak_memory = result
+                    # best of repeated phases
+                    best = {}
+                    for timing in timings:
+                        if timing['phase'] not in best or timing['seconds'] < best[timing['phase']]['seconds']:
+                            best[timing['phase']] = timing
+                    case.update(phases=best, peak_memory_mb=peak_memory)
+                else:
+                    case.update(error=result)
+                print >> sys.stderr, json.dumps(case)
+                results.append(case)
+    return {'commit': _commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'size': size,
+            'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'results': results}
+
+
+def compare(report, previous):
+    # ratios of timings (current / previous): values > 1 are slower
+    def key(case):
+        return case['grid_type'], tuple(case['target_shape']), case['method']
+
+    before = {key(case): case for case in previous['results'] if 'phases' in case}
+    for case in report['results']:
+        if 'phases' not in case or key(case) not in before:
+            continue
+        old_phases = before[key(case)]['phases']
+        ratios = ['{}: {:.2f}'.format(phase, timing['seconds'] / old_phases[phase]['seconds'])
+                  for phase, timing in sorted(case['phases'].iteritems())
+                  if phase in old_phases and old_phases[phase]['seconds'] > 0]
+        print '{} {} {} -> {}'.format(case['grid_type'], case['target_shape'], case['method'], ', '.join(ratios))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of intertable builds and applications')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=METHODS)
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions of apply phases (best is reported)')
+    parser.add_argument('--output', help='JSON file of results (default: stdout)')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    report = run(args.size, args.methods, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        print json.dumps(report, indent=2)
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(report, json.load(fh))
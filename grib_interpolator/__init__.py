@@ -5,4 +5,5 @@ It was developed under the initiative Copernicus, EFAS operational center @ECMWF
 
 from base import Interpolator
 from gribreader import GRIBReader
+from models import TargetGrid
 
@@ -0,0 +1,271 @@
+"""
+This software comes as Open Source and licensed via AGPL v3.
+It was developed under the initiative Copernicus, EFAS operational center @ECMWF (Reading, UK).
+
+Analytic interpolation utils.
+Source grids made of latitude rows of equally spaced points (regular_ll, regular_gg, rotated_ll,
+and reduced_gg/reduced_ll grids, octahedral included) don't need any search structure:
+bracketing rows of a target point are found by binary search on row latitudes and
+neighbours within each row follow from first longitude and longitude increment of the row.
+Indexes and weights are computed for all target points at once.
+Target coordinates can be given as a models.TargetGrid (in place of target_lats), that keeps
+their coordinates in the frame of rotated source grids.
+"""
+
+from __future__ import division
+
+from functools import partial
+
+import numpy as np
+
+from grib_interpolator.instrumentation import default_instrumentation, TRANSFORM, QUERY, WEIGHTS
+from grib_interpolator.models import as_target_grid
+from grib_interpolator.utils import tiles, shrink
+
+# tolerance (degrees) for target points lying exactly on the border of a limited area grid
+_BORDER_TOLERANCE = 1e-6
+_EXACT_DISTANCE = 1e-12
+# bytes of temporaries for each target point processed at once (see memory_budget)
+_BYTES_PER_POINT = 512
+
+analytic_grid_types = ('regular_ll', 'regular_gg', 'rotated_ll', 'reduced_gg', 'reduced_ll')
+
+
+class GridRows(object):
+    """
+    Source grid described as latitude rows, in GRIB scanning order.
+    Each row has its own number of points, first longitude and longitude increment.
+    """
+
+    def __init__(self, row_lats, row_sizes, row_first_lons, row_dlons, is_global):
+        self.row_lats = np.asarray(row_lats, dtype=np.float64)
+        self.row_sizes = np.asarray(row_sizes, dtype=np.int64)
+        self.row_first_lons = np.asarray(row_first_lons, dtype=np.float64)
+        self.row_dlons = np.asarray(row_dlons, dtype=np.float64)
+        self.row_offsets = np.concatenate(([0], np.cumsum(self.row_sizes)[:-1]))
+        self.is_global = is_global
+        self.descending = self.row_lats.size > 1 and self.row_lats[0] > self.row_lats[-1]
+        self._ascending_lats = self.row_lats[::-1] if self.descending else self.row_lats
+
+    @property
+    def num_rows(self):
+        return self.row_lats.size
+
+    def bracketing_rows(self, lats):
+        """
+        Rows just above and below each target latitude (by binary search).
+        Returns valid mask and the two rows, in scanning order.
+        """
+        n = self.num_rows
+        lat_min, lat_max = self._ascending_lats[0], self._ascending_lats[-1]
+        upper = np.searchsorted(self._ascending_lats, lats, side='right')
+        lower = upper - 1
+        if self.is_global:
+            # between extreme rows and poles, neighbours are taken from the extreme row
+            valid = np.ones(lats.shape, dtype=bool)
+        else:
+            valid = (lats >= lat_min - _BORDER_TOLERANCE) & (lats <= lat_max + _BORDER_TOLERANCE)
+        lower = np.clip(lower, 0, n - 1)
+        upper = np.clip(upper, 0, n - 1)
+        if self.descending:
+            lower, upper = n - 1 - lower, n - 1 - upper
+        return valid, lower, upper
+
+    def bracketing_points(self, rows, lons):
+        """
+        Points just before and after each target longitude, along the given rows.
+        Returns valid mask and the two column indexes.
+        """
+        sizes = self.row_sizes[rows]
+        dlons = self.row_dlons[rows]
+        offsets = np.mod(lons - self.row_first_lons[rows] + _BORDER_TOLERANCE, 360.) - _BORDER_TOLERANCE
+        position = offsets / dlons
+        before = np.floor(position).astype(np.int64)
+        if self.is_global:
+            valid = np.ones(lons.shape, dtype=bool)
+            before = np.mod(before, sizes)
+            after = np.mod(before + 1, sizes)
+        else:
+            valid = position <= sizes - 1 + _BORDER_TOLERANCE / dlons
+            before = np.clip(before, 0, np.maximum(sizes - 2, 0))
+            after = np.minimum(before + 1, sizes - 1)
+        return valid, before, after
+
+    def point_lons(self, rows, columns):
+        return self.row_first_lons[rows] + columns * self.row_dlons[rows]
+
+    def neighbours(self, lats, lons):
+        """
+        Four surrounding source points for each target point.
+        Returns valid mask, indexes (n, 4) and angular distances (n, 4) in radians
+        """
+        valid, lower, upper = self.bracketing_rows(lats)
+        rows = np.stack((lower, lower, upper, upper), axis=1)
+        valid_lower, before_lower, after_lower = self.bracketing_points(lower, lons)
+        valid_upper, before_upper, after_upper = self.bracketing_points(upper, lons)
+        valid &= valid_lower & valid_upper
+        columns = np.stack((before_lower, after_lower, before_upper, after_upper), axis=1)
+        indexes = self.row_offsets[rows] + columns
+        distances = angular_distance(lats[:, np.newaxis], lons[:, np.newaxis],
+                                     self.row_lats[rows], self.point_lons(rows, columns))
+        return valid, indexes, distances
+
+
+def angular_distance(lats1, lons1, lats2, lons2):
+    # haversine formula, degrees in, radians out
+    lats1, lons1, lats2, lons2 = (np.radians(a) for a in (lats1, lons1, lats2, lons2))
+    a = np.sin((lats2 - lats1) / 2) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def rotate_to_grid(lats, lons, south_pole_lat, south_pole_lon):
+    # geographic coordinates to coordinates of a rotated grid with the given south pole
+    teta = np.radians(90 + south_pole_lat)
+    fi = np.radians(south_pole_lon)
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    x = np.cos(lons) * np.cos(lats)
+    y = np.sin(lons) * np.cos(lats)
+    z = np.sin(lats)
+    x_rot = np.cos(teta) * np.cos(fi) * x + np.cos(teta) * np.sin(fi) * y + np.sin(teta) * z
+    y_rot = -np.sin(fi) * x + np.cos(fi) * y
+    z_rot = -np.sin(teta) * np.cos(fi) * x - np.sin(teta) * np.sin(fi) * y + np.cos(teta) * z
+    return np.degrees(np.arcsin(np.clip(z_rot, -1, 1))), np.degrees(np.arctan2(y_rot, x_rot))
+
+
+def _first_last_lons(grid_details):
+    lon_first = grid_details.get('longitudeOfFirstGridPointInDegrees')
+    lon_last = grid_details.get('longitudeOfLastGridPointInDegrees')
+    if lon_last < lon_first:
+        lon_last += 360
+    return lon_first, lon_last
+
+
+def _check_scanning_mode(grid_details):
+    for key in ('iScansNegatively', 'jPointsAreConsecutive'):
+        if grid_details.is_defined(key) and grid_details.get(key):
+            raise ValueError('Analytic interpolation does not support {} scanning mode'.format(key))
+
+
+def regular_rows(grid_details, source_lats):
+    _check_scanning_mode(grid_details)
+    ni = grid_details.get('Ni')
+    nj = grid_details.get('Nj')
+    lon_first, lon_last = _first_last_lons(grid_details)
+    dlon = (lon_last - lon_first) / (ni - 1)
+    if grid_details.get('gridType') == 'regular_gg':
+        # gaussian latitudes are not equally spaced: read them from source grid
+        row_lats = np.reshape(source_lats, (nj, ni))[:, 0]
+    else:
+        row_lats = np.linspace(grid_details.get('latitudeOfFirstGridPointInDegrees'),
+                               grid_details.get('latitudeOfLastGridPointInDegrees'), nj)
+    is_global = abs(ni * dlon - 360) < dlon / 2
+    return GridRows(row_lats, np.repeat(ni, nj), np.repeat(lon_first, nj), np.repeat(dlon, nj), is_global)
+
+
+def reduced_rows(grid_details, source_lats, source_lons):
+    # rows (and the pl array) are read from source coordinates: a new row starts where latitude changes
+    _check_scanning_mode(grid_details)
+    source_lats = np.ravel(source_lats)
+    source_lons = np.ravel(source_lons)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(source_lats)) + 1))
+    sizes = np.diff(np.append(starts, source_lats.size))
+    first_lons = source_lons[starts]
+    if np.any(sizes < 2):
+        raise ValueError('Analytic interpolation needs at least two points per row in grid {}'.format(grid_details.grid_id))
+    dlons = np.mod(source_lons[starts + 1] - first_lons, 360.)
+    is_global = bool(np.all(np.abs(sizes * dlons - 360) < dlons / 2))
+    if is_global:
+        dlons = 360. / sizes
+    return GridRows(source_lats[starts], sizes, first_lons, dlons, is_global)
+
+
+def grid_rows(grid_details, source_lats, source_lons):
+    grid_type = grid_details.get('gridType')
+    if grid_type in ('reduced_gg', 'reduced_ll'):
+        return reduced_rows(grid_details, source_lats, source_lons)
+    elif grid_type in analytic_grid_types:
+        return regular_rows(grid_details, source_lats)
+    raise ValueError('Analytic interpolation is not available for gridType {}'.format(grid_type))
+
+
+def _prepare_targets(grid_details, target, positions, rotated_target):
+    # target coordinates at positions, in the frame of source grid
+    if grid_details.get('gridType').startswith('rotated') and not rotated_target:
+        south_pole = (grid_details.get('latitudeOfSouthernPoleInDegrees'),
+                      grid_details.get('longitudeOfSouthernPoleInDegrees'))
+        return target.transformed(('rotated', south_pole),
+                                  partial(rotate_to_grid, south_pole_lat=south_pole[0], south_pole_lon=south_pole[1]),
+                                  positions)
+    return target.flat_lats[positions], target.flat_lons[positions]
+
+
+def _nearest_weights(indexes, distances):
+    nearest = np.argmin(distances, axis=1)
+    return indexes[np.arange(indexes.shape[0]), nearest], None
+
+
+def _invdist_weights(indexes, distances):
+    exact = distances <= _EXACT_DISTANCE
+    exact_rows = np.any(exact, axis=1)
+    invs = 1 / np.where(exact_rows[:, np.newaxis], 1, distances)
+    coeffs = invs / np.sum(invs, axis=1)[:, np.newaxis]
+    # target points on a source point take exactly its value, weight = 1
+    exact_idxs = indexes[exact_rows, np.argmax(exact[exact_rows], axis=1)]
+    indexes[exact_rows] = exact_idxs[:, np.newaxis]
+    coeffs[exact_rows] = (1., 0., 0., 0.)
+    return indexes, coeffs
+
+
+def _build_table(weights_function, nnear, grid_details, source_lats, source_lons, target_lats, target_lons, mv,
+                 rotated_target, instrumentation, memory_budget):
+    # target points are processed in tiles, whose results are written into preallocated arrays
+    # (int32 positions and indexes, as stored in intertables)
+    instrumentation = instrumentation or default_instrumentation
+    rows = grid_rows(grid_details, source_lats, source_lons)
+    target = as_target_grid(target_lons, target_lats)
+    _, candidates = target.valid(mv)
+    shape = (candidates.size,) if nnear == 1 else (candidates.size, nnear)
+    positions = np.empty(candidates.size, dtype=np.int32)
+    indexes = np.empty(shape, dtype=np.int32)
+    weights = np.empty(shape) if nnear > 1 else None
+    count = 0
+    for start, stop in tiles(candidates.size, memory_budget, _BYTES_PER_POINT):
+        tile = candidates[start:stop]
+        with instrumentation.phase(TRANSFORM, points=tile.size):
+            lats, lons = _prepare_targets(grid_details, target, tile, rotated_target)
+        with instrumentation.phase(QUERY, points=tile.size) as info:
+            valid, tile_indexes, distances = rows.neighbours(lats, lons)
+            info['outs'] = np.count_nonzero(~valid)
+        with instrumentation.phase(WEIGHTS, points=tile.size - info['outs']):
+            tile_indexes, tile_weights = weights_function(tile_indexes[valid], distances[valid])
+        num_valid = tile_indexes.shape[0]
+        positions[count:count + num_valid] = tile[valid]
+        indexes[count:count + num_valid] = tile_indexes
+        if weights is not None:
+            weights[count:count + num_valid] = tile_weights
+        count += num_valid
+        instrumentation.progress(QUERY, stop, candidates.size)
+    if weights is None:
+        return shrink(positions, count), shrink(indexes, count)
+    return shrink(positions, count), shrink(indexes, count), shrink(weights, count)
+
+
+def analytic_nearest(grid_details, source_lats, source_lons, target_lats, target_lons, mv, rotated_target=False,
+                     instrumentation=None, memory_budget=None):
+    """
+    Returns flat positions of target points inside source grid and their nearest source point.
+    memory_budget: bytes of temporaries, if target points have to be processed in tiles
+    """
+    return _build_table(_nearest_weights, 1, grid_details, source_lats, source_lons, target_lats, target_lons, mv,
+                        rotated_target, instrumentation, memory_budget)
+
+
+def analytic_invdist(grid_details, source_lats, source_lons, target_lats, target_lons, mv, rotated_target=False,
+                     instrumentation=None, memory_budget=None):
+    """
+    Returns flat positions of target points inside source grid,
+    their 4 surrounding source points (n, 4) and inverse distance weights (n, 4)
+    """
+    return _build_table(_invdist_weights, 4, grid_details, source_lats, source_lons, target_lats, target_lons, mv,
+                        rotated_target, instrumentation, memory_budget)
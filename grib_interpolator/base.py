@@ -5,19 +5,32 @@ It was developed under the initiative Copernicus, EFAS operational center @ECMWF
 
 import os
 import abc
+from collections import OrderedDict
+from functools import partial
 
 import numpy as np
 
+from grib_interpolator.analyticlib import analytic_nearest, analytic_invdist
+from grib_interpolator.executors import Checkpoint
 from grib_interpolator.griblib import grib_nearest, grib_invdist, grib_invdist_parallel, grib_nearest_parallel
+from grib_interpolator.instrumentation import logger, default_instrumentation, APPLY, SAVE, LOAD
+from grib_interpolator.intertables import (intertables_cache, Intertable, IntertablesStore,
+                                            save_intertable, load_intertable, convert_intertable)
+from grib_interpolator.models import as_target_grid
 from grib_interpolator.scipylib import InverseDistance
-from grib_interpolator.utils import mask_it
+from grib_interpolator.utils import grid_fingerprint, source_statistics
 
 
 class _Interpolator(object):
     __metaclass__ = abc.ABCMeta
+    name = None
+    nnear = 1
+    # builds that can be resumed from a Checkpoint
+    resumable = False
 
     def __init__(self, source_lons, source_lats, source_grid_details, source_mv, target_mv,
-                 rotated_target=False, parallel=True, gid=1):
+                 rotated_target=False, parallel=True, gid=-1, executor=None, store=None, masked=True,
+                 instrumentation=None, prune_source=False, memory_budget=None):
         self.source_lons = source_lons
         self.source_lats = source_lats
         self.grid_details = source_grid_details
@@ -26,115 +39,148 @@ class _Interpolator(object):
         self.parallel = parallel
         self.rotated_target = rotated_target
         self.gid = gid
+        # executor of chunked intertable builds (see executors module)
+        self.executor = executor
+        # set by Interpolator to persist completed chunks of long builds
+        self.checkpoint = None
+        # folder where intermediate structures (e.g. KDTrees) can be saved
+        self.store = store
+        # results are masked arrays, otherwise plain arrays with target_mv in place
+        self.masked = masked
+        # receives phases of builds and applications (see instrumentation module)
+        self.instrumentation = instrumentation or default_instrumentation
+        # search trees are built only from source points near the target grid
+        self.prune_source = prune_source
+        # bytes of temporaries of intertable builds: target points are processed in tiles that fit in it
+        self.memory_budget = memory_budget
+
+    def _build_intertable(self, target_shape, positions, indexes, weights):
+        return Intertable(self.name, self.nnear, self.grid_details.grid_id, target_shape,
+                          np.asarray(positions, dtype=np.int32), np.asarray(indexes, dtype=np.int32),
+                          np.asarray(weights, dtype=np.float32), n_source=self.source_lons.size)
+
+    def _output(self, intertable, result):
+        # mask of target points without a value is computed once per intertable;
+        # each result gets its own copy, so that results can be modified independently
+        if not self.masked:
+            return result
+        mask = intertable.invalid
+        if result.ndim > mask.ndim:
+            mask = np.repeat(mask[np.newaxis], result.shape[0], axis=0)
+        else:
+            mask = mask.copy()
+        return np.ma.masked_array(result, mask=mask, fill_value=self.target_mv, copy=False)
 
-    @abc.abstractmethod
-    def interpolate(self, source_values, target_lons, target_lats):
-        raise NotImplementedError()
+    def interpolate_with_table(self, intertable, source_values, target_lons, target_lats, out=None):
+        with self.instrumentation.phase(APPLY, points=intertable.positions.size, fields=1):
+            result = intertable.apply(source_values, self.target_mv, out=out)
+        return self._output(intertable, result)
+
+    def interpolate_many_with_table(self, intertable, stack, target_lons, target_lats, out=None):
+        with self.instrumentation.phase(APPLY, points=intertable.positions.size, fields=len(stack)):
+            result = intertable.apply_many(stack, self.target_mv, out=out)
+        return self._output(intertable, result)
 
     @abc.abstractmethod
-    def interpolate_with_table(self, intertable, source_values, target_lons, target_lats):
+    def interpolate(self, source_values, target_lons, target_lats=None):
+        # target_lons can be a models.TargetGrid
         raise NotImplementedError()
 
 
 class ScipyNearest(_Interpolator):
-
-    def interpolate_with_table(self, intertable, source_values, target_lons, target_lats):
-        indexes = intertable['indexes']
-        z = source_values
-        z = np.append(z, self.target_mv)
-        result = z[indexes]
-        return result.reshape(target_lons.shape)
+    name = 'scipy_nearest'
 
     def __init__(self, *args, **kwargs):
         super(ScipyNearest, self).__init__(*args, **kwargs)
         self.scipy_interpolator = InverseDistance(self.source_lons, self.source_lats,
                                                   self.grid_details, nnear=1, target_mv=self.target_mv,
                                                   source_mv=self.source_mv, rotated_target=self.rotated_target,
-                                                  parallel=self.parallel)
-
-    def interpolate(self, source_values, target_lons, target_lats):
-        result, indexes, weights = self.scipy_interpolator.interpolate(source_values, target_lons, target_lats)
-        intertable = np.rec.fromarrays((indexes, weights), names=('indexes', 'coeffs'))
-        result = result.reshape(target_lons.shape)
+                                                  parallel=self.parallel, store=self.store,
+                                                  instrumentation=self.instrumentation,
+                                                  prune_source=self.prune_source,
+                                                  memory_budget=self.memory_budget)
+
+    def interpolate(self, source_values, target_lons, target_lats=None):
+        target = as_target_grid(target_lons, target_lats)
+        positions, indexes, weights = self.scipy_interpolator.table(target)
+        intertable = self._build_intertable(target.shape, positions, indexes, weights)
+        result = self.interpolate_with_table(intertable, source_values, target, None)
         return result, intertable
 
 
 class ScipyInvdist(ScipyNearest):
-
-    def interpolate_with_table(self, intertable, source_values, target_lons, target_lats):
-        indexes = intertable['indexes']
-        coeffs = intertable['coeffs']
-        z = source_values
-        z = np.append(z, self.target_mv)
-        result = np.einsum('ij,ij->i', coeffs, z[indexes])
-        return result.reshape(target_lons.shape)
+    name = 'scipy_invdist'
+    nnear = 4
 
     def __init__(self, *args, **kwargs):
         super(ScipyNearest, self).__init__(*args, **kwargs)
         self.scipy_interpolator = InverseDistance(self.source_lons, self.source_lats,
                                                   self.grid_details, nnear=4, target_mv=self.target_mv,
                                                   source_mv=self.source_mv, rotated_target=self.rotated_target,
-                                                  parallel=self.parallel)
+                                                  parallel=self.parallel, store=self.store,
+                                                  instrumentation=self.instrumentation,
+                                                  prune_source=self.prune_source,
+                                                  memory_budget=self.memory_budget)
 
 
 class GribNearest(_Interpolator):
+    name = 'grib_nearest'
+    resumable = True
 
-    def interpolate_with_table(self, intertable, source_values, target_lons, target_lats):
-        xs, ys, idxs = intertable[0], intertable[1], intertable[2]
-        result = np.empty(target_lons.shape)
-        result.fill(self.target_mv)
-        result = mask_it(result, self.target_mv)
-        result[xs, ys] = source_values[idxs]
-        return result
-
-    def __init__(self, *args, **kwargs):
-        super(GribNearest, self).__init__(*args, **kwargs)
-        self.gid = kwargs.get('gid', -1)
-
-    def interpolate(self, source_values, target_lons, target_lats):
-        result = np.empty(target_lons.shape)
-        result.fill(self.target_mv)
-        result = mask_it(result, self.target_mv)
+    def interpolate(self, source_values, target_lons, target_lats=None):
+        target = as_target_grid(target_lons, target_lats)
         if not self.parallel:
-            xs, ys, idxs = grib_nearest(self.gid, target_lats, target_lons, self.target_mv)
+            positions, idxs = grib_nearest(self.gid, target, None, self.target_mv,
+                                           self.executor, self.checkpoint, self.instrumentation)
         else:
-            xs, ys, idxs = grib_nearest_parallel(self.gid, target_lats, target_lons, self.target_mv)
-        intertable = np.asarray([xs, ys, idxs], dtype=np.int32)
-        result[xs, ys] = source_values[idxs]
+            positions, idxs = grib_nearest_parallel(self.gid, target, None, self.target_mv,
+                                                    self.executor, self.checkpoint, self.instrumentation)
+        intertable = self._build_intertable(target.shape, positions, idxs, np.ones(idxs.shape))
+        result = self.interpolate_with_table(intertable, source_values, target, None)
         return result, intertable
 
 
 class GribInvdist(GribNearest):
+    name = 'grib_invdist'
+    nnear = 4
 
-    def interpolate_with_table(self, intertable, source_values, target_lons, target_lats):
-        indexes = intertable['indexes']  # first two arrays of this group are target xs and ys indexes
-        coeffs = intertable['coeffs']
-        v = source_values
-        result = np.empty(target_lons.shape)
-        result.fill(self.target_mv)
-        result = mask_it(result, self.target_mv)
-        xs, ys, idxs1, idxs2, idxs3, idxs4, coeffs1, coeffs2, coeffs3, coeffs4 = indexes[0], indexes[1], indexes[2], indexes[3], indexes[4], indexes[5], coeffs[0], coeffs[1], coeffs[2], coeffs[3]
-        result[xs, ys] = v[idxs1] * coeffs1 + v[idxs2] * coeffs2 + v[idxs3] * coeffs3 + v[idxs4] * coeffs4
-        return result
-
-    def interpolate(self, source_values, target_lons, target_lats):
-        v = source_values
-        result = np.empty(target_lons.shape)
-        result.fill(self.target_mv)
-        result = mask_it(result, self.target_mv)
+    def interpolate(self, source_values, target_lons, target_lats=None):
+        target = as_target_grid(target_lons, target_lats)
         if not self.parallel:
-            xs, ys, idxs1, idxs2, idxs3, idxs4, coeffs1, coeffs2, coeffs3, coeffs4 = grib_invdist(self.gid, target_lats,
-                                                                                                  target_lons,
-                                                                                                  self.target_mv)
+            positions, idxs, coeffs = grib_invdist(self.gid, target, None, self.target_mv,
+                                                   self.executor, self.checkpoint, self.instrumentation)
         else:
-            xs, ys, idxs1, idxs2, idxs3, idxs4, coeffs1, coeffs2, coeffs3, coeffs4 = grib_invdist_parallel(self.gid,
-                                                                                                           target_lats,
-                                                                                                           target_lons,
-                                                                                                           self.target_mv)
-        indexes = np.asarray([xs, ys, idxs1, idxs2, idxs3, idxs4], dtype=np.int32)
-        coeffs = np.asarray([coeffs1, coeffs2, coeffs3, coeffs4, np.zeros(coeffs1.shape), np.zeros(coeffs1.shape)])
-        intertable = np.rec.fromarrays((indexes, coeffs), names=('indexes', 'coeffs'))
-        result[xs, ys] = v[idxs1] * coeffs1 + v[idxs2] * coeffs2 + v[idxs3] * coeffs3 + v[idxs4] * coeffs4
+            positions, idxs, coeffs = grib_invdist_parallel(self.gid, target, None, self.target_mv,
+                                                            self.executor, self.checkpoint, self.instrumentation)
+        intertable = self._build_intertable(target.shape, positions, idxs, coeffs)
+        result = self.interpolate_with_table(intertable, source_values, target, None)
+        return result, intertable
+
+
+class AnalyticNearest(_Interpolator):
+    name = 'analytic_nearest'
+
+    def interpolate(self, source_values, target_lons, target_lats=None):
+        target = as_target_grid(target_lons, target_lats)
+        positions, idxs = analytic_nearest(self.grid_details, self.source_lats, self.source_lons,
+                                           target, None, self.target_mv, self.rotated_target,
+                                           self.instrumentation, self.memory_budget)
+        intertable = self._build_intertable(target.shape, positions, idxs, np.ones(idxs.shape))
+        result = self.interpolate_with_table(intertable, source_values, target, None)
+        return result, intertable
+
+
+class AnalyticInvdist(AnalyticNearest):
+    name = 'analytic_invdist'
+    nnear = 4
+
+    def interpolate(self, source_values, target_lons, target_lats=None):
+        target = as_target_grid(target_lons, target_lats)
+        positions, idxs, coeffs = analytic_invdist(self.grid_details, self.source_lats, self.source_lons,
+                                                   target, None, self.target_mv, self.rotated_target,
+                                                   self.instrumentation, self.memory_budget)
+        intertable = self._build_intertable(target.shape, positions, idxs, coeffs)
+        result = self.interpolate_with_table(intertable, source_values, target, None)
         return result, intertable
 
 
@@ -142,6 +188,12 @@ _Interpolator.register(ScipyNearest)
 _Interpolator.register(ScipyInvdist)
 _Interpolator.register(GribNearest)
 _Interpolator.register(GribInvdist)
+_Interpolator.register(AnalyticNearest)
+_Interpolator.register(AnalyticInvdist)
+
+
+# relative rounding error of float32 (unit roundoff): see Interpolator dtype argument
+FLOAT32_ERROR_BOUND = 2. ** -24
 
 
 class Interpolator(object):
@@ -150,6 +202,8 @@ class Interpolator(object):
     scipy_invdist = ScipyInvdist
     grib_nearest = GribNearest
     grib_invdist = GribInvdist
+    analytic_nearest = AnalyticNearest
+    analytic_invdist = AnalyticInvdist
 
     def __init__(self, source_lats, source_lons, source_grid_details, **kwargs):
         self.source_lons = source_lons
@@ -162,25 +216,155 @@ class Interpolator(object):
         self.rotated_target = kwargs.get('rotated_target', False)
         self.parallel = kwargs.get('parallel', True)
         self.gid = kwargs.get('gid', -1)  # id of grib message (comes from reader)
+        self.executor = kwargs.get('executor')
+        # with masked=False results are plain arrays with target_mv (NaN by default) at points without a value
+        self.masked = kwargs.get('masked', True)
+        # values are converted to dtype (e.g. np.float32) and results have the same dtype.
+        # With float32, results differ from float64 ones by less than
+        # FLOAT32_ERROR_BOUND * (nnear + 2) * max(abs(values)); indexes and neighbours search are not affected
+        self.dtype = kwargs.get('dtype')
+        # instrumentation.Instrumentation receiving phases of builds and applications
+        # (default: logged by 'grib_interpolator' logger)
+        self.instrumentation = kwargs.get('instrumentation') or default_instrumentation
+        # with scipy methods, KD-trees are built only from source points in a padded region around the target grid
+        # (much smaller trees for regional targets on global grids). Intertables are the same.
+        self.prune_source = kwargs.get('prune_source', False)
+        # bytes of temporaries of intertable builds (scipy and analytic methods): target points are processed
+        # in tiles that fit in it and written into the preallocated intertable, so peak memory is bounded
+        # regardless of target grid size. By default, all target points are processed at once
+        self.memory_budget = kwargs.get('memory_budget')
         self.interpolation_method = '{}_{}'.format(self._method, self._mode)
-        self.intertable_filename = '{}_{}.npy'.format(self.grid_details.grid_id.replace('$', '_'),
-                                                      self.interpolation_method)
         self.intertables_dir = kwargs.get('store', './')
-        if not os.path.exists(self.intertables_dir):
-            os.makedirs(self.intertables_dir)
-        self.intertable_path = os.path.join(self.intertables_dir, self.intertable_filename)
+        # one store folder can be shared by all target grids:
+        # intertables are keyed on source and target grids fingerprints
+        self.store = IntertablesStore(self.intertables_dir)
+        self.source_fingerprint = grid_fingerprint(source_lats, source_lons)
+        # path of the last intertable used
+        self.intertable_path = None
+        # intertables saved with np.save by previous versions (one folder per target grid)
+        # are never used as they are: see convert_legacy_intertable
+        self.legacy_intertable_path = os.path.join(self.intertables_dir, '{}_{}.npy'.format(
+            self.grid_details.grid_id.replace('$', '_'), self.interpolation_method))
+        # loaded intertables are shared between Interpolator instances of the same process
+        self.cache = kwargs.get('cache', intertables_cache)
         self._interpolator = getattr(self, self.interpolation_method)(source_lons, source_lats,
                                                                       self.grid_details,
                                                                       self.source_mv, self.target_mv,
-                                                                      self.rotated_target, self.parallel)
-
-    def interpolate(self, source_values, target_lons, target_lats):
-
-        if not os.path.exists(self.intertable_path):
-            print 'Creating intertable {}'.format(self.intertable_path)
-            result, intertable = self._interpolator.interpolate(source_values, target_lons, target_lats)
-            np.save(self.intertable_path, intertable)
-            return result
-        intertable = np.load(self.intertable_path)
-        return self._interpolator.interpolate_with_table(intertable, source_values, target_lons, target_lats)
+                                                                      self.rotated_target, self.parallel,
+                                                                      gid=self.gid, executor=self.executor,
+                                                                      store=self.intertables_dir,
+                                                                      masked=self.masked,
+                                                                      instrumentation=self.instrumentation,
+                                                                      prune_source=self.prune_source,
+                                                                      memory_budget=self.memory_budget)
+
+    def _intertable_path(self, target_fingerprint):
+        return self.store.path_for(self.interpolation_method, self.grid_details.grid_id,
+                                   self.source_fingerprint, target_fingerprint)
+
+    def get_intertable_path(self, target_lons, target_lats=None):
+        return self._intertable_path(as_target_grid(target_lons, target_lats).fingerprint)
+
+    def _load_intertable(self, path, target_fingerprint):
+        self.store.check(path, self.interpolation_method, self.source_fingerprint, target_fingerprint)
+        with self.instrumentation.phase(LOAD, path=path):
+            return load_intertable(path)
+
+    def _get_intertable(self, target):
+        # returns None if intertable was not created yet
+        target_fingerprint = target.fingerprint
+        self.intertable_path = self._intertable_path(target_fingerprint)
+        if os.path.exists(self.intertable_path):
+            loader = partial(self._load_intertable, target_fingerprint=target_fingerprint)
+            return self.cache.get(self.intertable_path, loader=loader)
+        return None
+
+    def convert_legacy_intertable(self, target_lons, target_lats=None, legacy_path=None):
+        """
+        Migrates an intertable saved by previous versions (by default legacy_intertable_path) into the store,
+        keyed on source and target grids fingerprints. Legacy intertables are not keyed on the target grid:
+        target_lons, target_lats must be the grid the legacy intertable was created for
+        (e.g. the one of the folder it was saved in). Its shape is checked.
+        Returns the path of the converted intertable.
+        """
+        target = as_target_grid(target_lons, target_lats)
+        return convert_intertable(legacy_path or self.legacy_intertable_path, self.interpolation_method,
+                                  self.grid_details.grid_id, target.shape, self.source_lons.size,
+                                  path=self._intertable_path(target.fingerprint),
+                                  source_fingerprint=self.source_fingerprint, target_fingerprint=target.fingerprint)
+
+    def _create_intertable(self, source_values, target):
+        if os.path.exists(self.legacy_intertable_path):
+            logger.warning('Intertable %s of a previous version is not used: convert it with '
+                           'Interpolator.convert_legacy_intertable to avoid creating %s',
+                           self.legacy_intertable_path, self.intertable_path)
+        logger.info('Creating intertable %s', self.intertable_path)
+        target_fingerprint = target.fingerprint
+        checkpoint = None
+        if self._interpolator.resumable:
+            # a restarted build of the same intertable resumes from completed chunks
+            checkpoint = Checkpoint('{}.work'.format(self.intertable_path),
+                                    key='{}_{}_{}'.format(self.interpolation_method, self.source_fingerprint,
+                                                          target_fingerprint))
+        self._interpolator.checkpoint = checkpoint
+        try:
+            result, intertable = self._interpolator.interpolate(source_values, target)
+        finally:
+            self._interpolator.checkpoint = None
+        intertable.source_fingerprint = self.source_fingerprint
+        intertable.target_fingerprint = target_fingerprint
+        with self.instrumentation.phase(SAVE, path=self.intertable_path, points=intertable.positions.size):
+            save_intertable(self.intertable_path, intertable)
+        if checkpoint is not None:
+            checkpoint.cleanup()
+        self.cache.put(self.intertable_path, intertable)
+        return result, intertable
 
+    def interpolate(self, source_values, target_lons, target_lats=None, out=None):
+        """
+        target_lons can be a models.TargetGrid (target_lats is then not needed):
+        fingerprint and transformed coordinates of target grid are computed once for all interpolators using it.
+        out: optional array of shape target_lons.shape (e.g. a slice of an output cube, see utils.open_output_cube)
+        where result is written
+        """
+        if self.dtype is not None:
+            source_values = np.asarray(source_values, dtype=self.dtype)
+        target = as_target_grid(target_lons, target_lats)
+        intertable = self._get_intertable(target)
+        if intertable is None:
+            result, intertable = self._create_intertable(source_values, target)
+            if out is None and self.dtype is None:
+                return result
+        return self._interpolator.interpolate_with_table(intertable, source_values, target, None, out=out)
+
+    def interpolate_many(self, stack, target_lons, target_lats=None, out=None):
+        """
+        Interpolate several fields on the same source grid (e.g. all steps or all ensemble members)
+        stack: array of shape (n_fields, n_source_points)
+        out: optional array of shape (n_fields,) + target_lons.shape where results are written
+        Returns an array of shape (n_fields,) + target_lons.shape
+        """
+        stack = np.asarray(stack, dtype=self.dtype)
+        target = as_target_grid(target_lons, target_lats)
+        intertable = self._get_intertable(target)
+        if intertable is None:
+            _, intertable = self._create_intertable(stack[0], target)
+        return self._interpolator.interpolate_many_with_table(intertable, stack, target, None, out=out)
+
+    def interpolate_statistics(self, stack, target_lons, target_lats=None, statistics=('mean',)):
+        """
+        Statistics of several fields on the same source grid (e.g. ensemble members) on target grid.
+        Statistics are computed on source grid and only statistic fields are interpolated
+        (see utils.source_statistics for available statistics).
+        Interpolation is linear, so mean is exactly the mean of interpolated fields with any method.
+        With nearest methods all statistics are exact; with invdist other statistics are only approximated
+        (a warning is logged).
+        Returns an OrderedDict statistic -> array of shape target_lons.shape
+        """
+        nonlinear = [stat for stat in statistics if stat != 'mean']
+        if nonlinear and self._interpolator.nnear > 1:
+            logger.warning('Statistics %s are not exact with %s interpolation: they are computed on source grid '
+                           'and then interpolated', nonlinear, self.interpolation_method)
+        fields = source_statistics(np.asarray(stack), statistics)
+        results = self.interpolate_many(fields, target_lons, target_lats)
+        return OrderedDict(zip(statistics, results))
@@ -0,0 +1,155 @@
+"""
+This software comes as Open Source and licensed via AGPL v3.
+It was developed under the initiative Copernicus, EFAS operational center @ECMWF (Reading, UK).
+
+Executors used to build intertables chunk by chunk.
+A job is a function job(start, stop) processing target points [start, stop)
+and returning arrays for those points. Executors yield chunk results as soon as they are ready,
+so the caller can write them into preallocated arrays.
+With a Checkpoint, completed chunks are persisted to a work directory
+and a restarted build only computes the missing ones.
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from collections import namedtuple
+
+import numpy as np
+
+ChunkTiming = namedtuple('ChunkTiming', ('start', 'size', 'seconds', 'worker'))
+
+# job of the running ProcessPoolExecutor.
+# Worker processes are forked after it's set, so they inherit it (and gribapi handles) without pickling.
+_job = None
+
+
+def _run_chunk(bounds):
+    start, stop = bounds
+    started = time.time()
+    result = _job(start, stop)
+    return start, stop, result, time.time() - started, os.getpid()
+
+
+class SerialExecutor(object):
+
+    def __init__(self, chunk_size=10000, callback=None):
+        self.chunk_size = chunk_size
+        # callback(timing) is called after each chunk
+        self.callback = callback
+        self.timings = []
+
+    def _chunks(self, num_points):
+        return [(start, min(start + self.chunk_size, num_points)) for start in xrange(0, num_points, self.chunk_size)]
+
+    def _record(self, start, stop, seconds, worker):
+        timing = ChunkTiming(start, stop - start, seconds, worker)
+        self.timings.append(timing)
+        if self.callback:
+            self.callback(timing)
+
+    def map_chunks(self, job, num_points, checkpoint=None):
+        chunks = self._chunks(num_points)
+        if checkpoint is not None:
+            completed = checkpoint.completed()
+            for start, stop in chunks:
+                if (start, stop) in completed:
+                    yield start, stop, checkpoint.load(start, stop)
+            chunks = [chunk for chunk in chunks if chunk not in completed]
+        for start, stop, result in self._map(job, chunks):
+            if checkpoint is not None:
+                checkpoint.save(start, stop, result)
+            yield start, stop, result
+
+    def _map(self, job, chunks):
+        for start, stop in chunks:
+            started = time.time()
+            result = job(start, stop)
+            self._record(start, stop, time.time() - started, os.getpid())
+            yield start, stop, result
+
+
+class ProcessPoolExecutor(SerialExecutor):
+    """
+    Chunks are distributed dynamically to a pool of worker processes:
+    a worker takes the next chunk as soon as it finishes the previous one,
+    so chunks of cheap (out of grid) and expensive points are balanced.
+    """
+
+    def __init__(self, workers=None, chunk_size=2000, callback=None):
+        super(ProcessPoolExecutor, self).__init__(chunk_size=chunk_size, callback=callback)
+        self.workers = workers or multiprocessing.cpu_count()
+
+    def _map(self, job, chunks):
+        global _job
+        _job = job
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            for start, stop, result, seconds, worker in pool.imap_unordered(_run_chunk, chunks, chunksize=1):
+                self._record(start, stop, seconds, worker)
+                yield start, stop, result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _job = None
+
+
+class Checkpoint(object):
+    """
+    Work directory of a chunked build.
+    Each completed chunk is saved in its own file (written atomically),
+    tagged with a key identifying the build (e.g. source and target grid fingerprints).
+    """
+
+    def __init__(self, directory, key):
+        self.directory = directory
+        self.key = key
+        meta_path = os.path.join(self.directory, 'checkpoint.json')
+        if os.path.exists(self.directory) and self._stored_key(meta_path) != key:
+            # work directory of a different build, or of a build killed before its key was written:
+            # start from scratch
+            shutil.rmtree(self.directory)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+            tmp_path = '{}.{}.tmp'.format(meta_path, os.getpid())
+            with open(tmp_path, 'w') as fh:
+                json.dump({'key': key}, fh)
+            os.rename(tmp_path, meta_path)
+
+    @staticmethod
+    def _stored_key(meta_path):
+        # None if meta file is missing or unreadable
+        try:
+            with open(meta_path) as fh:
+                return json.load(fh).get('key')
+        except (IOError, ValueError, AttributeError):
+            return None
+
+    def _chunk_path(self, start, stop):
+        return os.path.join(self.directory, 'chunk_{}_{}.npz'.format(start, stop))
+
+    def completed(self):
+        completed = set()
+        for filename in os.listdir(self.directory):
+            if filename.startswith('chunk_') and filename.endswith('.npz'):
+                start, stop = filename[len('chunk_'):-len('.npz')].split('_')
+                completed.add((int(start), int(stop)))
+        return completed
+
+    def save(self, start, stop, result):
+        arrays = result if isinstance(result, tuple) else (result,)
+        tmp_path = '{}.{}.tmp'.format(self._chunk_path(start, stop), os.getpid())
+        with open(tmp_path, 'wb') as fh:
+            np.savez(fh, *arrays)
+        os.rename(tmp_path, self._chunk_path(start, stop))
+
+    def load(self, start, stop):
+        with np.load(self._chunk_path(start, stop)) as data:
+            arrays = tuple(data['arr_{}'.format(i)] for i in xrange(len(data.files)))
+        return arrays if len(arrays) > 1 else arrays[0]
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
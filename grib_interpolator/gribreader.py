@@ -3,14 +3,15 @@ This software comes as Open Source and licensed via AGPL v3.
 It was developed under the initiative Copernicus, EFAS operational center @ECMWF (Reading, UK).
 """
 
+import collections
 import os
 
-from gribapi import (grib_no_fail_on_wrong_length, grib_is_defined,
-                     grib_index_new_from_file, grib_new_from_index, grib_new_from_file, grib_index_select,
-                     grib_index_release, grib_release,
-                     grib_get, grib_get_double_array, grib_get_double,
-                     GribInternalError,)
+import numpy as np
+from gribapi import (grib_no_fail_on_wrong_length, grib_is_defined, grib_new_from_file, grib_release,
+                     grib_get, grib_get_double_array,)
 
+from headers import scan_headers, select, headers_index_path, load_headers, save_headers
+from instrumentation import logger
 from models import GribGridDetails, Step, Messages
 import utils
 
@@ -28,17 +29,18 @@ class GRIBInfo(object):
 
 class GRIBReader(object):
 
-    def __init__(self, grib_file, indexes=('shortName',)):
+    def __init__(self, grib_file, indexes=('shortName',), persistent_index=False, index_dir=None, dtype=np.float64):
         grib_no_fail_on_wrong_length(True)
         self._grib_file = os.path.abspath(grib_file)
-        self._file_handler = None
-        self._grbindx = None
-        index_keys = indexes
-
-        try:
-            self._grbindx = grib_index_new_from_file(str(self._grib_file), index_keys)
-        except GribInternalError:
-            self._file_handler = open(self._grib_file)
+        self._file_handler = open(self._grib_file, 'rb')
+        # keys stored in headers table besides headers.HEADER_KEYS
+        self._index_keys = indexes
+        self._headers = None
+        # headers table is saved in an index file next to GRIB file (or in index_dir, if given)
+        # and reused while GRIB file is unchanged
+        self.index_path = headers_index_path(self._grib_file, index_dir) if persistent_index or index_dir else None
+        # dtype of decoded values (e.g. np.float32 halves memory of decoded messages)
+        self.dtype = np.dtype(dtype)
         self._selected_grbs = []
         self._mv = -1
         self._step_grib = -1
@@ -46,12 +48,19 @@ class GRIBReader(object):
         self._change_step_at = ''
         self._gid_main_res = None
         self._gid_ext_res = None
+        # set by iter_messages
+        self.grid_details = None
+        self.missing_value = None
+        self.unit = None
+        self.type_of_level = None
+        self.type_of_step = None
 
     @classmethod
     def get_id(cls, grib_file, reader_args):
         reader = GRIBReader(grib_file)
-        gribs_for_id = reader._get_gids(**reader_args)
-        grid = GribGridDetails(gribs_for_id[0])
+        gid = reader._gid_at(reader._select(**reader_args)['offset'][0])
+        grid = GribGridDetails(gid)
+        grib_release(gid)
         reader.close()
         return grid.grid_id
 
@@ -70,58 +79,66 @@ class GRIBReader(object):
                 return False
         return True
 
+    @property
+    def headers(self):
+        # headers table (one row per message), file is scanned at first access
+        if self._headers is None and self.index_path:
+            self._headers = load_headers(self.index_path, self._grib_file, self._index_keys)
+        if self._headers is None:
+            self._headers = scan_headers(self._file_handler, self._index_keys)
+            if self.index_path:
+                self._save_index()
+        return self._headers
+
+    def _save_index(self):
+        try:
+            save_headers(self.index_path, self._grib_file, self._headers)
+        except (IOError, OSError) as e:
+            # e.g. GRIB file in a read only folder: the file is scanned again next time
+            logger.warning('Cannot save index %s: %s', self.index_path, e)
+
     def close(self):
-        for g in self._selected_grbs:
+        for g in self._selected_grbs or ():
             grib_release(g)
         self._selected_grbs = None
-        if self._grbindx:
-            grib_index_release(self._grbindx)
-            self._grbindx = None
         if self._file_handler:
             self._file_handler.close()
             self._file_handler = None
 
+    def _values(self, gid):
+        return grib_get_double_array(gid, 'values').astype(self.dtype, copy=False)
+
+    def _gid_at(self, offset, headers_only=False):
+        self._file_handler.seek(offset)
+        return grib_new_from_file(self._file_handler, headers_only=headers_only)
+
+    def _matches(self, offset, kwargs):
+        gid = self._gid_at(offset, headers_only=True)
+        try:
+            return GRIBReader._find(gid, **kwargs)
+        finally:
+            grib_release(gid)
+
+    def _select(self, **kwargs):
+        # rows of headers table of selected messages
+        mask, unresolved = select(self.headers, **kwargs)
+        if not mask.any() and ('startStep' in kwargs and utils.is_callable(kwargs['startStep']) and not kwargs['startStep'](0)):
+            kwargs['startStep'] = lambda s: s >= 0
+            mask, unresolved = select(self.headers, **kwargs)
+        rows = self.headers[mask]
+        if unresolved:
+            # filters on keys not in headers table are checked on selected messages only
+            rows = rows[np.array([self._matches(offset, unresolved) for offset in rows['offset']], dtype=bool)]
+        return rows
+
     def scan_grib(self, gribs, kwargs):
-        v_selected = kwargs['shortName']
-        v_pert = kwargs.get('perturbationNumber', -1)
-        grib_append = gribs.append
-        if not utils.is_container(v_selected):
-            v_selected = [v_selected]
-        if self._grbindx:
-            for v in v_selected:
-                grib_index_select(self._grbindx, 'shortName', str(v))
-                if v_pert != -1:
-                    grib_index_select(self._grbindx, 'perturbationNumber', int(v_pert))
-                while 1:
-                    gid = grib_new_from_index(self._grbindx)
-                    if gid is None:
-                        break
-                    if GRIBReader._find(gid, **kwargs):
-                        grib_append(gid)
-                    else:
-                        # release unused grib
-                        grib_release(gid)
-        elif self._file_handler:
-            while 1:
-                gid = grib_new_from_file(self._file_handler)
-                if gid is None:
-                    break
-                if GRIBReader._find(gid, **kwargs):
-                    grib_append(gid)
-                else:
-                    # release unused grib
-                    grib_release(gid)
+        for offset in self._select(**kwargs)['offset']:
+            gribs.append(self._gid_at(offset))
 
     def _get_gids(self, **kwargs):
         gribs = []
-        try:
-            self.scan_grib(gribs, kwargs)
-            if (len(gribs) == 0) and ('startStep' in kwargs and utils.is_callable(kwargs['startStep']) and not kwargs['startStep'](0)):
-                kwargs['startStep'] = lambda s: s >= 0
-                self.scan_grib(gribs, kwargs)
-            return gribs
-        except ValueError:
-            raise ValueError('No messages in grib file')
+        self.scan_grib(gribs, kwargs)
+        return gribs
 
     def select_messages(self, **kwargs):
         self._selected_grbs = self._get_gids(**kwargs)
@@ -160,7 +177,7 @@ class GRIBReader(object):
                     grid2 = GribGridDetails(g)
                     self._gid_ext_res = g
 
-                values = grib_get_double_array(g, 'values')
+                values = self._values(g)
                 if not grid2:
                     all_values[key] = values
                 elif points_meridian != grid.num_points_along_meridian:
@@ -174,13 +191,123 @@ class GRIBReader(object):
         else:
             raise ValueError('No messages in grib file')
 
+    def iter_messages(self, **kwargs):
+        """
+        Returns a generator of (Step, values) of selected messages, ordered by end step.
+        Messages are scanned here, then decoded one at a time and released right after decoding.
+        Grid details (with second spatial resolution, if any) are available in reader.grid_details
+        as soon as this method returns. Use reader.grid_details_for(step) to get the grid of a message.
+        """
+        rows = self._select(**kwargs)
+        if rows.size == 0:
+            raise ValueError('No messages in grib file')
+        self._gid_main_res = self._gid_at(rows['offset'][0])
+        self._selected_grbs = [self._gid_main_res]
+        grid = GribGridDetails(self._gid_main_res)
+        # some cumulated messages come with the message at step=0 as instant, to permit aggregation
+        metadata = rows[1] if rows.size > 1 else rows[0]
+        self.unit = metadata['units']
+        self.type_of_step = metadata['stepType']
+        self.type_of_level = rows['levelType'][0]
+        self.missing_value = rows['missingValue'][0]
+
+        rows = rows[np.argsort(rows['endStep'], kind='mergesort')]
+        steps = self._steps(rows)
+
+        second_res = [i for i, step in enumerate(steps) if step.resolution != grid.num_points_along_meridian]
+        if second_res:
+            self._gid_ext_res = self._gid_at(rows['offset'][second_res[0]])
+            self._selected_grbs.append(self._gid_ext_res)
+            grid.set_2nd_resolution(GribGridDetails(self._gid_ext_res), min(steps[i] for i in second_res))
+        self.grid_details = grid
+        return self._decode_messages(steps, rows['offset'].tolist())
+
+    def _steps(self, rows):
+        # Step keys of rows ordered by end step
+        input_step = self._step_grib
+        steps = []
+        for start_step, end_step, points_meridian in zip(rows['startStep'].tolist(), rows['endStep'].tolist(),
+                                                         rows['Nj'].tolist()):
+            if '{}-{}'.format(start_step, end_step) == self._change_step_at:
+                # second time resolution
+                input_step = self._step_grib2
+            steps.append(Step(start_step, end_step, points_meridian, input_step))
+        return steps
+
+    def select_groups(self, **kwargs):
+        """
+        Selects messages of several variables, ensemble members and levels in a single pass over the file.
+        Returns an OrderedDict (shortName, perturbationNumber, level) -> Messages.
+        Messages on the same grids share the same GribGridDetails object.
+        perturbationNumber is utils.int_fill_value for messages without it.
+        """
+        rows = self._select(**kwargs)
+        if rows.size == 0:
+            raise ValueError('No messages in grib file')
+        group_keys = zip(rows['shortName'].tolist(), rows['perturbationNumber'].tolist(), rows['level'].tolist())
+        groups = collections.OrderedDict()
+        for i, key in enumerate(group_keys):
+            groups.setdefault(key, []).append(i)
+
+        # messages are read in file order; first message of each spatial resolution is kept for grid details
+        order = np.argsort(rows['offset'], kind='mergesort')
+        values = [None] * rows.size
+        aux_gids = {}
+        for i in order:
+            gid = self._gid_at(rows['offset'][i])
+            values[i] = self._values(gid)
+            if rows['Nj'][i] not in aux_gids:
+                aux_gids[rows['Nj'][i]] = gid
+            else:
+                grib_release(gid)
+        self._selected_grbs = aux_gids.values()
+        self._gid_main_res = aux_gids[rows['Nj'][0]]
+
+        grids = {}
+        result = collections.OrderedDict()
+        for key, indexes in groups.iteritems():
+            group = rows[indexes]
+            main_nj = group['Nj'][0]
+            by_end_step = np.argsort(group['endStep'], kind='mergesort')
+            steps = self._steps(group[by_end_step])
+            all_values, all_values_second_res = {}, {}
+            for step, i in zip(steps, np.asarray(indexes)[by_end_step]):
+                (all_values if step.resolution == main_nj else all_values_second_res)[step] = values[i]
+            second_nj = min(all_values_second_res).resolution if all_values_second_res else None
+            if (main_nj, second_nj) not in grids:
+                grid = GribGridDetails(aux_gids[main_nj])
+                if second_nj is not None:
+                    grid.set_2nd_resolution(GribGridDetails(aux_gids[second_nj]), min(all_values_second_res))
+                grids[main_nj, second_nj] = grid
+            # some cumulated messages come with the message at step=0 as instant, to permit aggregation
+            metadata = group[1] if group.size > 1 else group[0]
+            result[key] = Messages(all_values, group['missingValue'][0], metadata['units'], group['levelType'][0],
+                                   metadata['stepType'], grids[main_nj, second_nj], all_values_second_res)
+        return result
+
+    def _decode_messages(self, steps, offsets):
+        with open(self._grib_file, 'rb') as fh:
+            for step, offset in zip(steps, offsets):
+                fh.seek(offset)
+                gid = grib_new_from_file(fh)
+                try:
+                    values = self._values(gid)
+                finally:
+                    grib_release(gid)
+                yield step, values
+
+    def grid_details_for(self, step):
+        # grid of a message yielded by iter_messages
+        grid2 = self.grid_details.get_2nd_resolution()
+        if grid2 is not None and step.resolution == grid2.num_points_along_meridian:
+            return grid2
+        return self.grid_details
+
     @staticmethod
-    def _find_start_end_steps(gribs):
+    def _find_start_end_steps(start_steps, end_steps):
         # return input_steps,
         # change step if a second time resolution is found
 
-        start_steps = [grib_get(gribs[i], 'startStep') for i in xrange(len(gribs))]
-        end_steps = [grib_get(gribs[i], 'endStep') for i in xrange(len(gribs))]
         start_grib = min(start_steps)
         end_grib = max(end_steps)
         ord_end_steps = sorted(end_steps)
@@ -196,18 +323,14 @@ class GRIBReader(object):
         return start_grib, end_grib, step, step2, change_step_at
 
     def get_grib_info(self, select_args):
-        _gribs_for_utils = self._get_gids(**select_args)
-        if len(_gribs_for_utils) > 0:
-            type_of_step = grib_get(_gribs_for_utils[1], 'stepType')  # instant, avg, cumul
+        # only the headers table is read
+        rows = self._select(**select_args)
+        if rows.size > 0:
+            type_of_step = rows['stepType'][1]  # instant, avg, cumul
             # FIXME this is not correct: GRIB missing values needs bitmap
-            self._mv = grib_get_double(_gribs_for_utils[0], 'missingValue')
-            start_grib, end_grib, self._step_grib, self._step_grib2, self._change_step_at = self._find_start_end_steps(_gribs_for_utils)
-            for g in _gribs_for_utils:
-                grib_release(g)
-            _gribs_for_utils = None
-            del _gribs_for_utils
-            import gc
-            gc.collect()
+            self._mv = float(rows['missingValue'][0])
+            start_grib, end_grib, self._step_grib, self._step_grib2, self._change_step_at = self._find_start_end_steps(
+                rows['startStep'].tolist(), rows['endStep'].tolist())
             info = GRIBInfo(input_step=self._step_grib, input_step2=self._step_grib2,
                             change_step_at=self._change_step_at, type_of_param=type_of_step,
                             start=start_grib, end=end_grib, mv=self._mv)
@@ -218,10 +341,10 @@ class GRIBReader(object):
 
     def get_gids_for_intertable(self):
         # returns gids of messages to use to create interpolation tables
-        val = grib_get_double_array(self._gid_main_res, 'values')
+        val = self._values(self._gid_main_res)
         val2 = None
         if self._gid_ext_res:
-            val2 = grib_get_double_array(self._gid_ext_res, 'values')
+            val2 = self._values(self._gid_ext_res)
         return self._gid_main_res, val, self._gid_ext_res, val2
 
     def set_2nd_aux(self, aux_2nd_gid):
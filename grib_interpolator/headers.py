@@ -0,0 +1,139 @@
+"""
+This software comes as Open Source and licensed via AGPL v3.
+It was developed under the initiative Copernicus, EFAS operational center @ECMWF (Reading, UK).
+
+Headers table of a GRIB file.
+The file is scanned once (headers only) into a numpy structured array, one row per message,
+with the most used header keys and the message offset in file.
+Selections run as vectorized queries on the table: filters can be values, containers of values or callables
+(called once per distinct value of the key).
+Tables can be persisted in index files (next to the GRIB file or in a cache folder), valid as long as
+path, size and modification time of the GRIB file don't change.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+from gribapi import grib_new_from_file, grib_is_defined, grib_get, grib_release
+
+from grib_interpolator import utils
+
+# key, dtype. Missing keys are stored as int_fill_value, nan or empty string
+HEADER_KEYS = (('shortName', 'S32'), ('perturbationNumber', '<i8'), ('level', '<i8'), ('levelType', 'S32'),
+               ('startStep', '<i8'), ('endStep', '<i8'), ('stepType', 'S32'), ('Nj', '<i8'),
+               ('units', 'S64'), ('missingValue', '<f8'), ('offset', '<i8'))
+HEADERS_INDEX_EXTENSION = '.hidx'
+HEADERS_INDEX_VERSION = 1
+
+
+def _missing(dtype):
+    kind = np.dtype(dtype).kind
+    return utils.int_fill_value if kind == 'i' else np.nan if kind == 'f' else ''
+
+
+def _extra_dtype(values):
+    # dtype of a key not in HEADER_KEYS, from its values
+    defined = [v for v in values if v is not None]
+    if defined and all(isinstance(v, (int, long)) for v in defined):
+        return '<i8'
+    elif defined and all(isinstance(v, (int, long, float)) for v in defined):
+        return '<f8'
+    return 'S64'
+
+
+def scan_headers(file_handler, extra_keys=()):
+    """
+    Reads headers of all messages in file.
+    extra_keys: keys to store besides HEADER_KEYS
+    """
+    keys = [key for key, _ in HEADER_KEYS] + [key for key in extra_keys if key not in dict(HEADER_KEYS)]
+    rows = []
+    file_handler.seek(0)
+    while 1:
+        gid = grib_new_from_file(file_handler, headers_only=True)
+        if gid is None:
+            break
+        try:
+            rows.append(tuple(grib_get(gid, key) if grib_is_defined(gid, key) else None for key in keys))
+        finally:
+            grib_release(gid)
+    dtypes = dict(HEADER_KEYS)
+    columns = zip(*rows) if rows else [()] * len(keys)
+    dtype = [(key, dtypes.get(key) or _extra_dtype(column)) for key, column in zip(keys, columns)]
+    missing = [_missing(dt) for _, dt in dtype]
+    return np.array([tuple(m if v is None else v for v, m in zip(row, missing)) for row in rows], dtype=dtype)
+
+
+def _is_missing(column):
+    if column.dtype.kind == 'i':
+        return column == utils.int_fill_value
+    elif column.dtype.kind == 'f':
+        return np.isnan(column)
+    return column == ''
+
+
+def select(headers, **kwargs):
+    """
+    Returns a boolean mask of rows matching all filters, and the filters on keys not in table
+    (to be checked on messages).
+    """
+    mask = np.ones(headers.shape, dtype=bool)
+    unresolved = {}
+    for key, value in kwargs.iteritems():
+        if key not in headers.dtype.names:
+            unresolved[key] = value
+            continue
+        column = headers[key]
+        # messages without the key are never selected
+        defined = ~_is_missing(column)
+        if utils.is_callable(value):
+            distinct, inverse = np.unique(column[defined], return_inverse=True)
+            key_mask = np.zeros(column.shape, dtype=bool)
+            key_mask[defined] = np.array([bool(value(v)) for v in distinct.tolist()], dtype=bool)[inverse]
+        elif utils.is_container(value):
+            key_mask = np.in1d(column, list(value))
+        else:
+            key_mask = column == value
+        mask &= key_mask & defined
+    return mask, unresolved
+
+
+def headers_index_path(grib_file, index_dir=None):
+    # index file next to the GRIB file or, in a shared folder, prefixed by a hash of the GRIB file path
+    grib_file = os.path.abspath(grib_file)
+    if not index_dir:
+        return grib_file + HEADERS_INDEX_EXTENSION
+    prefix = hashlib.sha1(grib_file.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(index_dir, '{}_{}{}'.format(prefix, os.path.basename(grib_file), HEADERS_INDEX_EXTENSION))
+
+
+def _file_key(grib_file):
+    stat = os.stat(grib_file)
+    return {'path': os.path.abspath(grib_file), 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'version': HEADERS_INDEX_VERSION}
+
+
+def save_headers(path, grib_file, headers):
+    # atomic write: concurrent jobs opening the same file never read a partial index
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fh:
+        np.savez(fh, headers=headers, key=np.array(json.dumps(_file_key(grib_file))))
+    os.rename(tmp_path, path)
+
+
+def load_headers(path, grib_file, keys=()):
+    """
+    Returns the headers table saved in path,
+    or None if the index is missing, stale (GRIB file changed) or lacks any of the given keys
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        if json.loads(str(data['key'])) != _file_key(grib_file):
+            return None
+        headers = data['headers']
+    if any(key not in headers.dtype.names for key in keys):
+        return None
+    return headers
@@ -0,0 +1,121 @@
+"""
+This software comes as Open Source and licensed via AGPL v3.
+It was developed under the initiative Copernicus, EFAS operational center @ECMWF (Reading, UK).
+
+Instrumentation of intertable builds and applications.
+Engines report the phases they run (see PHASES) to an instrumentation object:
+phase_started(phase, **info) and phase_ended(phase, seconds, **info), where info has the number of points
+and, for searches, the number of target points out of source grid (outs).
+Long builds also report progress(phase, done, total) once per chunk of target points.
+By default events go to the 'grib_interpolator' logger: nothing is written unless logging is configured,
+and messages are formatted only if the logger is enabled for their level.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger('grib_interpolator')
+logger.addHandler(logging.NullHandler())
+
+TRANSFORM = 'transform'
+TREE_BUILD = 'tree_build'
+QUERY = 'query'
+WEIGHTS = 'weights'
+SAVE = 'save'
+LOAD = 'load'
+APPLY = 'apply'
+PHASES = (TRANSFORM, TREE_BUILD, QUERY, WEIGHTS, SAVE, LOAD, APPLY)
+
+
+class Instrumentation(object):
+    """
+    Receives events and ignores them. Subclass it and override the events you need.
+    """
+
+    def phase_started(self, phase, **info):
+        pass
+
+    def phase_ended(self, phase, seconds, **info):
+        pass
+
+    def progress(self, phase, done, total):
+        pass
+
+    @contextmanager
+    def phase(self, phase, **info):
+        # info can be updated in the with block (e.g. outs found by a search)
+        self.phase_started(phase, **info)
+        started = time.time()
+        yield info
+        self.phase_ended(phase, time.time() - started, **info)
+
+
+def _format_info(info):
+    return ' '.join('{}={}'.format(key, value) for key, value in sorted(info.iteritems()))
+
+
+class LoggingInstrumentation(Instrumentation):
+    """
+    Ends of phases are logged at given level, starts of phases and progress at DEBUG level.
+    """
+
+    def __init__(self, logger=logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def phase_started(self, phase, **info):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Start %s %s', phase, _format_info(info))
+
+    def phase_ended(self, phase, seconds, **info):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, 'End %s: %.3fs %s', phase, seconds, _format_info(info))
+
+    def progress(self, phase, done, total):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('%s: %d/%d (%.2f%%)', phase, done, total, done * 100. / max(total, 1))
+
+
+class Metrics(Instrumentation):
+    """
+    Accumulates calls, seconds, points and outs of each phase, e.g. to be exported to a monitoring system.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    def phase_ended(self, phase, seconds, **info):
+        record = self.phases.setdefault(phase, {'calls': 0, 'seconds': 0., 'points': 0, 'outs': 0})
+        record['calls'] += 1
+        record['seconds'] += seconds
+        record['points'] += info.get('points', 0)
+        record['outs'] += info.get('outs', 0)
+
+    def reset(self):
+        self.phases.clear()
+
+
+class MultipleInstrumentation(Instrumentation):
+    """
+    Forwards events to several instrumentation objects (e.g. Metrics and LoggingInstrumentation).
+    """
+
+    def __init__(self, *instrumentations):
+        self.instrumentations = instrumentations
+
+    def phase_started(self, phase, **info):
+        for instrumentation in self.instrumentations:
+            instrumentation.phase_started(phase, **info)
+
+    def phase_ended(self, phase, seconds, **info):
+        for instrumentation in self.instrumentations:
+            instrumentation.phase_ended(phase, seconds, **info)
+
+    def progress(self, phase, done, total):
+        for instrumentation in self.instrumentations:
+            instrumentation.progress(phase, done, total)
+
+
+default_instrumentation = LoggingInstrumentation()
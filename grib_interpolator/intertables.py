@@ -0,0 +1,428 @@
+"""
+This software comes as Open Source and licensed via AGPL v3.
+It was developed under the initiative Copernicus, EFAS operational center @ECMWF (Reading, UK).
+"""
+
+import collections
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+try:
+    # sparse mat-vec product accumulating into a given output array
+    from scipy.sparse._sparsetools import csr_matvec
+except ImportError:
+    csr_matvec = None
+
+INTERTABLE_MAGIC = b'\x93GRIBITAB'
+INTERTABLE_VERSION = 1
+INTERTABLE_EXTENSION = '.itab'
+_ALIGNMENT = 64
+_ARRAYS = (('positions', '<i4'), ('indexes', '<i4'), ('weights', '<f4'))
+
+
+class IntertablesCache(object):
+    """
+    Process-wide LRU cache of loaded intertables.
+    Entries are keyed by intertable path, file mtime and file size,
+    so a table rewritten on disk is never served stale.
+    Tables are charged their nbytes, updated when they build derived arrays (e.g. sparse matrices) at first use.
+    """
+
+    def __init__(self, max_bytes=1024 ** 3):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tables = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime, stat.st_size
+
+    @staticmethod
+    def _sizeof(table):
+        return getattr(table, 'nbytes', 0)
+
+    def get(self, path, loader=np.load):
+        key = self._key(path)
+        with self._lock:
+            entry = self._tables.pop(key, None)
+            if entry is not None:
+                self._tables[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        table = loader(path)
+        self._insert(key, table)
+        return table
+
+    def put(self, path, table):
+        self._insert(self._key(path), table)
+
+    def _insert(self, key, table):
+        size = self._sizeof(table)
+        if size > self.max_bytes:
+            # table alone exceeds the budget: don't cache it
+            return
+        with self._lock:
+            # entries of the same file before it was rewritten (and itself) can't be hit anymore
+            for old_key in [k for k in self._tables if k[0] == key[0]]:
+                self.current_bytes -= self._tables.pop(old_key)[1]
+            # entries are (table, charged bytes)
+            self._tables[key] = table, size
+            self.current_bytes += size
+            self._evict()
+        callbacks = getattr(table, 'resize_callbacks', None)
+        if callbacks is not None and self._resized not in callbacks:
+            callbacks.append(self._resized)
+
+    def _resized(self, table):
+        # a cached table has grown (or shrunk) after it was inserted
+        with self._lock:
+            for key, (cached, size) in self._tables.items():
+                if cached is table:
+                    new_size = self._sizeof(table)
+                    self._tables[key] = table, new_size
+                    self.current_bytes += new_size - size
+            self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._tables:
+            _, (_, size) = self._tables.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._tables), 'bytes': self.current_bytes, 'max_bytes': self.max_bytes}
+
+    def __len__(self):
+        return len(self._tables)
+
+
+intertables_cache = IntertablesCache()
+
+
+class Intertable(object):
+    """
+    Indexes and weights to interpolate values from a source grid to a target grid.
+
+    positions: flat indexes of the target points that get a value, shape (n,)
+    indexes: source points used for each target point, shape (n, nnear)
+    weights: coefficients of each source point, shape (n, nnear)
+    Target points not listed in positions (out of source grid or invalid target coords) get the missing value.
+    """
+
+    def __init__(self, method, nnear, grid_id, target_shape, positions, indexes, weights, n_source=None,
+                 source_fingerprint=None, target_fingerprint=None):
+        self.method = method
+        self.nnear = int(nnear)
+        self.grid_id = grid_id
+        self.target_shape = tuple(int(d) for d in target_shape)
+        self.n_source = None if n_source is None else int(n_source)
+        self.source_fingerprint = source_fingerprint
+        self.target_fingerprint = target_fingerprint
+        self.positions = positions
+        self.indexes = indexes.reshape(-1, self.nnear)
+        self.weights = weights.reshape(-1, self.nnear)
+        self._valid = None
+        self._invalid = None
+        self._matrix = None
+        self._typed_matrices = {}
+        # functions called with the table when derived arrays are built, e.g. to update memory charged by caches
+        self.resize_callbacks = []
+
+    @property
+    def target_size(self):
+        return int(np.prod(self.target_shape))
+
+    @property
+    def nbytes(self):
+        # table arrays and arrays derived from them (masks and sparse matrices), shared memory counted once
+        arrays = [self.positions, self.indexes, self.weights, self._valid, self._invalid]
+        for matrix in [self._matrix] + self._typed_matrices.values():
+            if matrix is not None:
+                arrays.extend((matrix.data, matrix.indices, matrix.indptr))
+        counted = []
+        for array in arrays:
+            if array is not None and not any(np.may_share_memory(array, other) for other in counted):
+                counted.append(array)
+        return sum(array.nbytes for array in counted)
+
+    def _resized(self):
+        for callback in self.resize_callbacks:
+            callback(self)
+
+    @property
+    def header(self):
+        return {'version': INTERTABLE_VERSION, 'method': self.method, 'nnear': self.nnear,
+                'grid_id': self.grid_id, 'target_shape': list(self.target_shape), 'n_source': self.n_source,
+                'source_fingerprint': self.source_fingerprint, 'target_fingerprint': self.target_fingerprint}
+
+    @property
+    def valid(self):
+        # boolean mask of target points that get a value
+        if self._valid is None:
+            valid = np.zeros(self.target_size, dtype=bool)
+            valid[self.positions] = True
+            self._valid = valid
+            self._resized()
+        return self._valid
+
+    @property
+    def invalid(self):
+        # target points without a value, with target grid shape
+        if self._invalid is None:
+            self._invalid = ~self.valid.reshape(self.target_shape)
+            self._resized()
+        return self._invalid
+
+    @property
+    def matrix(self):
+        # sparse (n_target, n_source) matrix: interpolation is a single mat-vec product.
+        # Target points without a value are empty rows
+        if self._matrix is None:
+            positions, indexes, weights = self.positions, self.indexes, self.weights
+            if np.any(np.diff(positions) < 0):
+                order = np.argsort(positions, kind='mergesort')
+                positions, indexes, weights = positions[order], indexes[order], weights[order]
+            indptr = np.zeros(self.target_size + 1, dtype=np.int64)
+            indptr[positions + 1] = self.nnear
+            np.cumsum(indptr, out=indptr)
+            n_source = self.n_source if self.n_source is not None else int(indexes.max()) + 1
+            self._matrix = csr_matrix((weights.ravel(), indexes.ravel(), indptr),
+                                      shape=(self.target_size, n_source), copy=False)
+            self._resized()
+        return self._matrix
+
+    def _typed_matrix(self, values):
+        # weights are upcast once per dtype instead of at every product
+        dtype = np.result_type(values, self.weights)
+        matrix = self._typed_matrices.get(dtype)
+        if matrix is None:
+            matrix = self.matrix
+            if dtype != matrix.dtype:
+                # only weights are copied: indices and indptr are shared with the table matrix
+                matrix = csr_matrix((matrix.data.astype(dtype), matrix.indices, matrix.indptr),
+                                    shape=matrix.shape, copy=False)
+            self._typed_matrices[dtype] = matrix
+            self._resized()
+        return matrix
+
+    @staticmethod
+    def _dot(matrix, values, out):
+        # out = matrix * values, written in place when out is contiguous and of the same dtype of matrix
+        if csr_matvec is not None and out.flags.c_contiguous and out.dtype == matrix.dtype:
+            flat = out.reshape(-1)
+            flat.fill(0)
+            try:
+                csr_matvec(matrix.shape[0], matrix.shape[1], matrix.indptr, matrix.indices, matrix.data,
+                           np.ascontiguousarray(values, dtype=matrix.dtype), flat)
+                return
+            except TypeError:
+                # private scipy function: signature or supported types may change between versions
+                pass
+        np.copyto(out, matrix.dot(values).reshape(out.shape), casting='same_kind')
+
+    def apply(self, values, mv, out=None):
+        # out: optional array of target_shape where result is written
+        matrix = self._typed_matrix(values)
+        if out is None:
+            result = matrix.dot(values).reshape(self.target_shape)
+        else:
+            result = out
+            self._dot(matrix, values, result)
+        result[self.invalid] = mv
+        return result
+
+    def apply_many(self, stack, mv, out=None):
+        # stack has shape (n_fields, n_source_points), out (optional) has shape (n_fields,) + target_shape
+        matrix = self._typed_matrix(stack)
+        if out is None:
+            result = matrix.dot(stack.T).T.reshape((stack.shape[0],) + self.target_shape)
+        else:
+            result = out
+            for i in xrange(stack.shape[0]):
+                self._dot(matrix, stack[i], result[i])
+        result[:, self.invalid] = mv
+        return result
+
+
+def _padding(offset):
+    return (-offset) % _ALIGNMENT
+
+
+def save_intertable(path, intertable):
+    header = intertable.header
+    arrays = [(name, np.ascontiguousarray(getattr(intertable, name), dtype=dtype)) for name, dtype in _ARRAYS]
+    # offsets are relative to the end of the header block
+    offset = 0
+    header['arrays'] = {}
+    for name, array in arrays:
+        header['arrays'][name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset += array.nbytes + _padding(array.nbytes)
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    prefix_size = len(INTERTABLE_MAGIC) + 4
+    header_bytes += b' ' * _padding(prefix_size + len(header_bytes))
+    # written to a temporary file and renamed: a partial intertable is never found at path
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as fh:
+            fh.write(INTERTABLE_MAGIC)
+            fh.write(struct.pack('<I', len(header_bytes)))
+            fh.write(header_bytes)
+            for _, array in arrays:
+                fh.write(array.tobytes())
+                fh.write(b'\0' * _padding(array.nbytes))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _read_header(fh, path):
+    magic = fh.read(len(INTERTABLE_MAGIC))
+    if magic != INTERTABLE_MAGIC:
+        raise ValueError('{} is not an intertable file'.format(path))
+    header_size, = struct.unpack('<I', fh.read(4))
+    header = json.loads(fh.read(header_size).decode('utf-8'))
+    if header['version'] > INTERTABLE_VERSION:
+        raise ValueError('Intertable {} has unsupported version {}'.format(path, header['version']))
+    header['data_offset'] = len(INTERTABLE_MAGIC) + 4 + header_size
+    return header
+
+
+def read_header(path):
+    with open(path, 'rb') as fh:
+        return _read_header(fh, path)
+
+
+def load_intertable(path, mmap=True):
+    header = read_header(path)
+    arrays = {}
+    for name, info in header['arrays'].iteritems():
+        shape = tuple(info['shape'])
+        offset = header['data_offset'] + info['offset']
+        if not mmap or not np.prod(shape):
+            with open(path, 'rb') as fh:
+                fh.seek(offset)
+                arrays[name] = np.fromfile(fh, dtype=info['dtype'], count=int(np.prod(shape))).reshape(shape)
+        else:
+            # pages are shared between processes loading the same intertable
+            arrays[name] = np.memmap(path, dtype=info['dtype'], mode='r', offset=offset, shape=shape)
+    return Intertable(header['method'], header['nnear'], header['grid_id'], header['target_shape'],
+                      arrays['positions'], arrays['indexes'], arrays['weights'], n_source=header['n_source'],
+                      source_fingerprint=header.get('source_fingerprint'),
+                      target_fingerprint=header.get('target_fingerprint'))
+
+
+def load_legacy_intertable(path, method, grid_id, target_shape, n_source):
+    """
+    Load an intertable saved with np.save by previous versions of grib_interpolator.
+    n_source (number of source points) is needed because scipy tables
+    mark target points out of source grid with index n_source.
+    """
+    table = np.load(path)
+    target_shape = tuple(target_shape)
+    wrong_shape = ValueError('Intertable {} was not created for a target grid of shape {}'.format(path, target_shape))
+    if method.startswith('scipy') and len(table) != np.prod(target_shape):
+        raise wrong_shape
+    if method.startswith('grib'):
+        # only (x, y) of target points inside source grid are stored: they must fit in target shape
+        xs, ys = (table[0], table[1]) if method == 'grib_nearest' else (table['indexes'][0], table['indexes'][1])
+        if len(target_shape) != 2 or (xs.size and (xs.min() < 0 or ys.min() < 0 or
+                                                   xs.max() >= target_shape[0] or ys.max() >= target_shape[1])):
+            raise wrong_shape
+    if method == 'scipy_nearest':
+        indexes = table['indexes']
+        valid = indexes != n_source
+        positions = np.flatnonzero(valid)
+        indexes = indexes[valid]
+        weights = np.ones(indexes.shape)
+    elif method == 'scipy_invdist':
+        indexes = table['indexes']
+        valid = indexes[:, 0] != n_source
+        positions = np.flatnonzero(valid)
+        indexes = indexes[valid]
+        weights = table['coeffs'][valid]
+    elif method == 'grib_nearest':
+        xs, ys, indexes = table[0], table[1], table[2]
+        positions = np.ravel_multi_index((xs, ys), target_shape)
+        weights = np.ones(indexes.shape)
+    elif method == 'grib_invdist':
+        # legacy coeffs record was padded with two all-zero rows
+        xs, ys = table['indexes'][0], table['indexes'][1]
+        positions = np.ravel_multi_index((xs, ys), target_shape)
+        indexes = table['indexes'][2:6].T
+        weights = table['coeffs'][:4].T
+    else:
+        raise ValueError('Unknown interpolation method {}'.format(method))
+    nnear = 1 if indexes.ndim == 1 else indexes.shape[1]
+    return Intertable(method, nnear, grid_id, target_shape,
+                      positions.astype(np.int32), indexes.astype(np.int32), weights.astype(np.float32),
+                      n_source=n_source)
+
+
+def convert_intertable(legacy_path, method, grid_id, target_shape, n_source, path=None,
+                       source_fingerprint=None, target_fingerprint=None):
+    """
+    Migrate a legacy .npy intertable to the current format.
+    With source and target fingerprints, the converted intertable can be used from an IntertablesStore
+    (see Interpolator.convert_legacy_intertable).
+    Returns the path of the converted intertable (legacy file is left untouched).
+    """
+    if path is None:
+        path = os.path.splitext(legacy_path)[0] + INTERTABLE_EXTENSION
+    intertable = load_legacy_intertable(legacy_path, method, grid_id, target_shape, n_source)
+    intertable.source_fingerprint = source_fingerprint
+    intertable.target_fingerprint = target_fingerprint
+    save_intertable(path, intertable)
+    return path
+
+
+class IntertablesStore(object):
+    """
+    Content-addressed folder of intertables.
+    Tables are keyed on the fingerprints of both source and target grids,
+    so a single folder can serve any number of target grids.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def path_for(self, method, grid_id, source_fingerprint, target_fingerprint):
+        filename = '{}_{}_{}_{}{}'.format(grid_id.replace('$', '_'), method, source_fingerprint[:12],
+                                          target_fingerprint[:12], INTERTABLE_EXTENSION)
+        return os.path.join(self.directory, filename)
+
+    @staticmethod
+    def check(path, method, source_fingerprint, target_fingerprint):
+        # only the header is read here
+        header = read_header(path)
+        expected = (method, source_fingerprint, target_fingerprint)
+        found = (header['method'], header.get('source_fingerprint'), header.get('target_fingerprint'))
+        if found != expected:
+            raise ValueError('Intertable {} does not match source and target grids: '
+                             'expected {} found {}'.format(path, expected, found))
@@ -6,6 +6,9 @@ It was developed under the initiative Copernicus, EFAS operational center @ECMWF
 import collections
 
 import gribapi
+import numpy as np
+
+from grib_interpolator.utils import grid_fingerprint, valid_coordinates
 
 
 class Step(object):
@@ -47,8 +50,10 @@ class GribGridDetails(object):
     keys = (('gridType', 'string'), ('radius', 'double'), ('numberOfValues', 'long'),
             ('Ni', 'long'), ('Nj', 'long'), ('missingValue', 'double'),
             ('longitudeOfFirstGridPointInDegrees', 'double'), ('longitudeOfLastGridPointInDegrees', 'double'),
+            ('latitudeOfFirstGridPointInDegrees', 'double'), ('latitudeOfLastGridPointInDegrees', 'double'),
             ('latitudeOfSouthernPoleInDegrees', 'double'), ('longitudeOfSouthernPoleInDegrees', 'double'),
-            ('angleOfRotationInDegrees', 'double'))
+            ('angleOfRotationInDegrees', 'double'),
+            ('iScansNegatively', 'long'), ('jScansPositively', 'long'), ('jPointsAreConsecutive', 'long'))
     check_for_missing_keys = ('Ni', 'Nj',)
 
     def __init__(self, gid):
@@ -121,6 +126,9 @@ class GribGridDetails(object):
     def get(self, geo_key):
         return self._geo_keys[geo_key]
 
+    def is_defined(self, geo_key):
+        return geo_key in self._geo_keys
+
     def __str__(self):
         return str(self._geo_keys)
 
@@ -149,6 +157,11 @@ class Messages(object):
                                                                          key=lambda (k, v_): (int(k.end_step), v_)))
         return self.values_first_or_single_res
 
+    def first_resolution_stack(self):
+        # steps (ordered by end step) and values stacked in a (n_steps, n_points) array
+        values = self.first_resolution_values()
+        return values.keys(), np.stack(values.values())
+
     def second_resolution_values(self):
         self.values_second_res = collections.OrderedDict(sorted(self.values_second_res.iteritems(),
                                                                 key=lambda (k, v_): (int(k.end_step), v_)))
@@ -179,3 +192,83 @@ class Messages(object):
 
     def __len__(self):
         return len(self.values_first_or_single_res) + len(self.values_second_res)
+
+
+class TargetGrid(object):
+    """
+    Target grid coordinates and what interpolators derive from them: fingerprint, valid points
+    and transformed coordinates (e.g. Cartesian coordinates of KD-tree searches, plain or rotated).
+    Pass the same TargetGrid to all interpolators of a process in place of target_lons and target_lats,
+    so that all is computed once for any number of source grids.
+    With cache=False, transformed coordinates are not kept and are computed only for requested points.
+    """
+
+    def __init__(self, lats, lons, cache=True):
+        self.lats = np.asarray(lats)
+        self.lons = np.asarray(lons)
+        if self.lats.shape != self.lons.shape:
+            raise ValueError('Target lats and lons have different shapes: {} {}'.format(self.lats.shape,
+                                                                                     self.lons.shape))
+        # views, unless coordinates are not contiguous
+        self.flat_lats = np.ravel(self.lats)
+        self.flat_lons = np.ravel(self.lons)
+        self.cache = cache
+        self._fingerprint = None
+        self._valid = {}
+        self._transformed = {}
+
+    @property
+    def shape(self):
+        return self.lons.shape
+
+    @property
+    def size(self):
+        return self.lons.size
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = grid_fingerprint(self.lats, self.lons)
+        return self._fingerprint
+
+    def valid(self, mv):
+        """
+        Flat mask of points with valid coordinates (see utils.valid_coordinates) and their positions
+        """
+        # repr, as NaN is never equal to itself
+        key = repr(mv)
+        if key not in self._valid:
+            mask = valid_coordinates(self.flat_lons, mv)
+            self._valid[key] = mask, np.flatnonzero(mask)
+        return self._valid[key]
+
+    def transformed(self, key, function, positions=slice(None)):
+        """
+        function(flat_lats, flat_lons) at positions (slice or index array). It must return an array
+        or a tuple of arrays of the same length of its arguments.
+        With cache, it's computed once for all points and kept under key
+        (e.g. Cartesian coordinates on a sphere of given radius).
+        """
+        if not self.cache:
+            return function(self.flat_lats[positions], self.flat_lons[positions])
+        if key not in self._transformed:
+            self._transformed[key] = function(self.flat_lats, self.flat_lons)
+        values = self._transformed[key]
+        if isinstance(values, tuple):
+            return tuple(v[positions] for v in values)
+        return values[positions]
+
+    def clear(self):
+        # releases transformed coordinates
+        self._transformed.clear()
+
+
+def as_target_grid(target_lons, target_lats=None):
+    """
+    The TargetGrid passed in place of target coordinates (as target_lons or target_lats),
+    or a new one wrapping given coordinates, that doesn't keep transformed coordinates.
+    """
+    for target in (target_lons, target_lats):
+        if isinstance(target, TargetGrid):
+            return target
+    return TargetGrid(target_lats, target_lons, cache=False)
@@ -0,0 +1,191 @@
+"""
+This software comes as Open Source and licensed via AGPL v3.
+It was developed under the initiative Copernicus, EFAS operational center @ECMWF (Reading, UK).
+
+Pipeline overlapping decoding, interpolation and writing of messages.
+Messages are decoded by a background thread and results are written by another one,
+while interpolation runs in the calling thread. Stages are connected by bounded queues,
+so at most queue_size decoded fields and queue_size results are in memory at the same time.
+Intertables must not be built inside run, while the other threads are live: GRIB API is not thread safe,
+and parallel builds fork worker processes that can inherit locks held by other threads and deadlock.
+They are built (or loaded) by prepare, or with the first message before threads start.
+"""
+
+import os
+import Queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+# end of stream marker
+_DONE = object()
+# seconds between checks of the stop flag while waiting on a queue
+_POLL = 0.1
+
+
+class NpyWriter(object):
+    """
+    Writes each result to a numpy file named as {start_step}_{end_step}_{variable}.npy
+    """
+
+    def __init__(self, folder, variable):
+        self.folder = folder
+        self.variable = variable
+
+    def __call__(self, step, result):
+        out_file = os.path.join(self.folder, '{}_{}_{}.npy'.format(step.start_step, step.end_step, self.variable))
+        # masked arrays are saved with target_mv in place
+        np.save(out_file, np.ma.getdata(result))
+
+
+class Pipeline(object):
+
+    def __init__(self, interpolator, target_lons, target_lats, writer, queue_size=4, interpolator_2nd=None):
+        self.interpolator = interpolator
+        # used for messages at second spatial resolution, if any
+        self.interpolator_2nd = interpolator_2nd
+        self.target_lons = target_lons
+        self.target_lats = target_lats
+        # writer(step, result) is called in the writer thread
+        self.writer = writer
+        self.queue_size = queue_size
+        # seconds spent in each stage during last run
+        self.timings = {}
+        self._stop = threading.Event()
+        self._errors = []
+        self._prepared = False
+
+    def prepare(self, source_values, source_values_2nd=None):
+        """
+        Builds (or loads) intertables in the calling thread, before run.
+        source_values: values of any message on the source grid (e.g. from GRIBReader.get_gids_for_intertable)
+        source_values_2nd: same, at second spatial resolution (needed with interpolator_2nd)
+        """
+        if self.interpolator_2nd is not None and source_values_2nd is None:
+            raise ValueError('Values at second spatial resolution are needed to prepare interpolator_2nd')
+        self.interpolator.interpolate(source_values, self.target_lons, self.target_lats)
+        if self.interpolator_2nd is not None:
+            self.interpolator_2nd.interpolate(source_values_2nd, self.target_lons, self.target_lats)
+        self._prepared = True
+
+    def _interpolator_for(self, step):
+        if self.interpolator_2nd is not None:
+            if step.resolution == self.interpolator_2nd.grid_details.num_points_along_meridian:
+                return self.interpolator_2nd
+        else:
+            grid2 = self.interpolator.grid_details.get_2nd_resolution()
+            if grid2 is not None and step.resolution == grid2.num_points_along_meridian:
+                raise ValueError('Message {} is at second spatial resolution: interpolator_2nd is needed'.format(step))
+        return self.interpolator
+
+    def _put(self, queue, item):
+        # returns False if pipeline was stopped before item could be queued
+        while not self._stop.is_set():
+            try:
+                queue.put(item, timeout=_POLL)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def _get(self, queue):
+        while not self._stop.is_set():
+            try:
+                return queue.get(timeout=_POLL)
+            except Queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self):
+        self._errors.append(sys.exc_info())
+        self._stop.set()
+
+    def _time(self, stage, started):
+        self.timings[stage] += time.time() - started
+
+    def _decode(self, messages, decoded):
+        try:
+            iterator = iter(messages)
+            while True:
+                started = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                self._time('decode', started)
+                if not self._put(decoded, item):
+                    return
+            self._put(decoded, _DONE)
+        except Exception:
+            self._fail()
+
+    def _write(self, results):
+        try:
+            while True:
+                item = self._get(results)
+                if item is _DONE:
+                    return
+                step, result = item
+                started = time.time()
+                self.writer(step, result)
+                self._time('write', started)
+        except Exception:
+            self._fail()
+
+    def run(self, messages):
+        """
+        messages: iterable of (Step, values), e.g. GRIBReader.iter_messages(...)
+        If prepare was not called, the first message is interpolated before starting threads
+        (a pipeline with interpolator_2nd must be prepared).
+        Returns the number of processed messages.
+        """
+        self._stop.clear()
+        self._errors = []
+        self.timings = {'decode': 0., 'interpolate': 0., 'write': 0.}
+        iterator = iter(messages)
+        first = _DONE
+        if not self._prepared:
+            if self.interpolator_2nd is not None:
+                raise ValueError('Pipeline with interpolator_2nd must be prepared before run')
+            started = time.time()
+            first = next(iterator, _DONE)
+            self._time('decode', started)
+            if first is not _DONE:
+                step, values = first
+                started = time.time()
+                first = step, self._interpolator_for(step).interpolate(values, self.target_lons, self.target_lats)
+                self._time('interpolate', started)
+            self._prepared = True
+        decoded = Queue.Queue(self.queue_size)
+        results = Queue.Queue(self.queue_size)
+        decoder = threading.Thread(target=self._decode, args=(iterator, decoded), name='pipeline-decode')
+        writer = threading.Thread(target=self._write, args=(results,), name='pipeline-write')
+        decoder.daemon = writer.daemon = True
+        decoder.start()
+        writer.start()
+        processed = 0
+        try:
+            if first is not _DONE and self._put(results, first):
+                processed += 1
+            while True:
+                item = self._get(decoded)
+                if item is _DONE:
+                    break
+                step, values = item
+                started = time.time()
+                result = self._interpolator_for(step).interpolate(values, self.target_lons, self.target_lats)
+                self._time('interpolate', started)
+                if not self._put(results, (step, result)):
+                    break
+                processed += 1
+            self._put(results, _DONE)
+        except Exception:
+            self._fail()
+        decoder.join()
+        writer.join()
+        if self._errors:
+            error_type, error, traceback = self._errors[0]
+            raise error_type, error, traceback
+        return processed
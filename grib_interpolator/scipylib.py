@@ -5,164 +5,390 @@ It was developed under the initiative Copernicus, EFAS operational center @ECMWF
 
 from __future__ import division
 
-from itertools import izip
-from math import radians
-from sys import stdout
+import cPickle
+import os
+from collections import OrderedDict
+from functools import partial
+from math import radians, pi
 
 import numexpr as ne
 import numpy as np
 from scipy.spatial import cKDTree as KDTree
 
-from grib_interpolator.utils import mask_it, progress_step_and_backchar, empty, now_string
+from grib_interpolator.instrumentation import (logger, default_instrumentation, TRANSFORM, TREE_BUILD, QUERY,
+                                                WEIGHTS, SAVE, LOAD)
+from grib_interpolator.models import as_target_grid
+from grib_interpolator.utils import empty, grid_fingerprint, tiles, shrink
 
 np.seterr(all='ignore')
 
+KDTREE_EXTENSION = '.kdtree'
+# KD-trees (and neighbour distance bounds) of source grids, shared by InverseDistance instances of the process
+_trees = OrderedDict()
+_MAX_TREES = 4
+# source points queried to estimate the distance bound of grids without regular rows
+_BOUND_SAMPLES = 100000
+# padding of the target region used to prune source points, in source grid spacings (pi / Nj):
+# neighbours of target points are always within it
+_REGION_PADDING = 4
+# bytes of temporaries for each target point processed at once (see memory_budget), and for each neighbour
+_BYTES_PER_POINT = 96
+_BYTES_PER_NEIGHBOUR = 64
+
+# numexpr formulas (lons, lats in radians), built once
+_X = 'cos(lons) * cos(lats)'
+_Y = 'sin(lons) * cos(lats)'
+_Z = 'sin(lats)'
+# Cartesian coordinates on a sphere of radius r
+XYZ_FORMULAS = tuple('r * {}'.format(formula) for formula in (_X, _Y, _Z))
+# same, from coordinates in the frame of a rotated grid (teta: 90 + latitude, fi: longitude of its south pole)
+ROTATED_XYZ_FORMULAS = (
+    'r * ((cos(teta) * cos(fi) * ({x})) - (sin(fi) * ({y})) - (sin(teta) * cos(fi) * ({z})))'.format(x=_X, y=_Y, z=_Z),
+    'r * ((cos(teta) * sin(fi) * ({x})) + (cos(fi) * ({y})) - (sin(teta) * sin(fi) * ({z})))'.format(x=_X, y=_Y, z=_Z),
+    'r * ((sin(teta) * ({x})) + (cos(teta) * ({z})))'.format(x=_X, z=_Z))
+# unit vectors in the frame of a rotated grid, from geographic coordinates
+TO_ROTATED_FORMULAS = (
+    '(cos(teta) * cos(fi) * ({x})) + (cos(teta) * sin(fi) * ({y})) + (sin(teta) * ({z}))'.format(x=_X, y=_Y, z=_Z),
+    '(-sin(fi) * ({x})) + (cos(fi) * ({y}))'.format(x=_X, y=_Y),
+    '(-sin(teta) * cos(fi) * ({x})) - (sin(teta) * sin(fi) * ({y})) + (cos(teta) * ({z}))'.format(x=_X, y=_Y, z=_Z))
+
+
+def clear_trees():
+    _trees.clear()
+
+
+def to_3d(lons, lats, radius, south_pole=None):
+    """
+    Cartesian coordinates x, y, z of points (degrees) on a sphere of given radius.
+    south_pole: (lat, lon) of the south pole of the rotated frame of given coordinates, if they are rotated
+    """
+    variables = {'lons': np.radians(lons), 'lats': np.radians(lats), 'r': radius}
+    formulas = XYZ_FORMULAS
+    if south_pole is not None:
+        variables.update(teta=radians(90 + south_pole[0]), fi=radians(south_pole[1]))
+        formulas = ROTATED_XYZ_FORMULAS
+    return tuple(ne.evaluate(formula, local_dict=variables) for formula in formulas)
+
+
+def _locations(lats, lons, radius, south_pole):
+    # (n, 3) array of Cartesian coordinates, as TargetGrid transformed coordinates
+    x, y, z = to_3d(lons, lats, radius, south_pole)
+    return np.vstack((x, y, z)).T
+
 
 class InverseDistance(object):
     """
     http://docs.scipy.org/doc/scipy/reference/spatial.html
+    KDTree of the source grid is cached in memory and, if a store folder is given, pickled there.
+    With prune_source=True, the tree is built for each target grid, only from source points
+    in a padded spherical cap around the target grid (e.g. a regional target on a global source grid).
+    With memory_budget (bytes), target points are processed in tiles whose temporaries fit in it.
+    Target coordinates can be given as a models.TargetGrid (in place of target_lons), that keeps
+    their Cartesian coordinates for all source grids with the same radius.
     """
 
     def __init__(self, sourcelons, sourcelats, grid_details, nnear, target_mv, source_mv,
-                 rotated_target=False, parallel=False):
-        stdout.write('Start scipy interpolation: {}\n'.format(now_string()))
+                 rotated_target=False, parallel=False, store=None, instrumentation=None, prune_source=False,
+                 memory_budget=None):
         self.geodetic_info = grid_details
+        self.instrumentation = instrumentation or default_instrumentation
         self.target_grid_is_rotated = rotated_target
         self.njobs = 1 if not parallel else -1
         self.nnear = nnear
+        self._mv_target = target_mv
+        self._mv_source = source_mv
+        self.prune_source = prune_source
+        self.memory_budget = memory_budget
+        self.n_source = np.size(sourcelons)
+        self._store = store
+        # indexes in source grid of the points in tree (None if tree has all source points)
+        self.source_indexes = None
+        if prune_source:
+            self._sourcelons, self._sourcelats = sourcelons, sourcelats
+            self.tree, self.min_upper_bound = None, None
+        else:
+            self.tree, self.min_upper_bound, _ = self._get_tree(sourcelons, sourcelats, store)
+
+    def _tree_key(self, sourcelons, sourcelats):
+        return '{}_{}_{}'.format(self.geodetic_info.grid_id.replace('$', '_'),
+                                 self.geodetic_info.get('radius'), grid_fingerprint(sourcelats, sourcelons)[:12])
+
+    def _get_tree(self, sourcelons, sourcelats, store, region=None):
+        # tree, bound and source indexes are built once per source grid (or per source and target grids
+        # if region is given): from memory, from the store folder or from scratch.
+        # region: (key, function returning the cap of target points) of the target grid whose neighbours
+        # are searched
+        key = self._tree_key(sourcelons, sourcelats)
+        if region is not None:
+            key = '{}_{}'.format(key, region[0])
+        if key in _trees:
+            _trees[key] = _trees.pop(key)
+            return _trees[key]
+        path = os.path.join(store, key + KDTREE_EXTENSION) if store else None
+        cached = None
+        if path and os.path.exists(path):
+            try:
+                with self.instrumentation.phase(LOAD, path=path):
+                    with open(path, 'rb') as fh:
+                        cached = cPickle.load(fh)
+                    if len(cached) != 3:
+                        raise ValueError('KDTree saved by a previous version')
+            except Exception as e:
+                # e.g. a tree pickled by another scipy version
+                logger.warning('Cannot load KDTree %s: %s', path, e)
+                cached = None
+        if cached is None:
+            cached = self._build_tree(sourcelons, sourcelats, region[1] if region is not None else None)
+            if path:
+                with self.instrumentation.phase(SAVE, path=path):
+                    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+                    with open(tmp_path, 'wb') as fh:
+                        cPickle.dump(cached, fh, cPickle.HIGHEST_PROTOCOL)
+                    os.rename(tmp_path, path)
+        _trees[key] = cached
+        while len(_trees) > _MAX_TREES:
+            _trees.popitem(last=False)
+        logger.debug('Skipping neighbors at distance > %s', cached[1])
+        return cached
+
+    def _build_tree(self, sourcelons, sourcelats, target_cap=None):
+        source_indexes, interior = None, None
+        cap = target_cap() if target_cap is not None else None
+        if cap is not None:
+            source_indexes, interior = self._region_indexes(sourcelons, sourcelats, cap)
+            if source_indexes is not None:
+                sourcelons = np.ravel(sourcelons)[source_indexes]
+                sourcelats = np.ravel(sourcelats)[source_indexes]
         # we receive rotated coords from GRIB_API iterator before 1.14.3
-        x, y, zz = self.to_3d(sourcelons, sourcelats)
-        source_locations = np.vstack((x.ravel(), y.ravel(), zz.ravel())).T
-        self.source_locations = source_locations
+        with self.instrumentation.phase(TRANSFORM, points=np.size(sourcelons)):
+            x, y, zz = self.to_3d(sourcelons, sourcelats)
+            source_locations = np.vstack((x.ravel(), y.ravel(), zz.ravel())).T
 
-        stdout.write('Building KDTree...\n')
-        self.tree = KDTree(source_locations, leafsize=30)  # build the tree
+        with self.instrumentation.phase(TREE_BUILD, points=source_locations.shape[0]):
+            tree = KDTree(source_locations, leafsize=30)  # build the tree
+            max_distance = self._max_neighbour_distance(tree, interior)
+        min_upper_bound = max_distance + max_distance * 4 / self.geodetic_info.get('Nj')
+        return tree, min_upper_bound, source_indexes
 
-        self._mv_target = target_mv
-        self._mv_source = source_mv
-        distances, indexes = self.tree.query(source_locations, k=2, n_jobs=self.njobs)
-        self.min_upper_bound = np.max(distances) + np.max(distances) * 4 / self.geodetic_info.get('Nj')
-        stdout.write('Skipping neighbors at distance > {}\n'.format(self.min_upper_bound))
+    @property
+    def _south_pole(self):
+        return (self.geodetic_info.get('latitudeOfSouthernPoleInDegrees'),
+                self.geodetic_info.get('longitudeOfSouthernPoleInDegrees'))
 
-    def interpolate(self, source_values, target_lons, target_lats):
-        # Target coordinates  HAVE to be rotated coords in case GRIB grid is rotated
-        # Examples of target rotated coords are COSMO lat/lon/dem PCRASTER maps
-        x, y, z = self.to_3d(target_lons, target_lats, to_regular=self.target_grid_is_rotated)
-        target_locations = np.vstack((x.ravel(), y.ravel(), z.ravel())).T
+    def _target_locations(self, target, positions):
+        # Cartesian coordinates of target points at positions, geographic even if target coordinates are rotated
+        radius = self.geodetic_info.get('radius')
+        south_pole = self._south_pole if self.target_grid_is_rotated else None
+        return target.transformed(('xyz', radius, south_pole),
+                                  partial(_locations, radius=radius, south_pole=south_pole), positions)
 
-        stdout.write('Finding indexes for nearest neighbour k={}\n'.format(self.nnear))
+    def _target_units(self, target, start, stop):
+        # unit vectors of valid target points of a tile
+        valid, _ = target.valid(self._mv_target)
+        locations = self._target_locations(target, slice(start, stop))[valid[start:stop]]
+        return locations / np.sqrt(np.einsum('ij,ij->i', locations, locations))[:, np.newaxis]
 
-        distances, indexes = self.tree.query(target_locations, k=self.nnear, n_jobs=self.njobs)
+    def _target_cap(self, target):
+        """
+        Spherical cap (center unit vector, angular radius) containing all valid target points,
+        or None if there are none or they surround the center of the sphere. Computed tile by tile.
+        """
+        bounds = tiles(target.size, self.memory_budget, self._bytes_per_point)
+        center = np.zeros(3)
+        for start, stop in bounds:
+            center += self._target_units(target, start, stop).sum(axis=0)
+        norm = np.sqrt(np.dot(center, center))
+        if norm == 0:
+            return None
+        center /= norm
+        min_cos = 1.
+        for start, stop in bounds:
+            units = self._target_units(target, start, stop)
+            if units.size:
+                min_cos = min(min_cos, np.min(units.dot(center)))
+        return center, np.arccos(np.clip(min_cos, -1, 1))
 
-        if self.nnear == 1:
-            # return distances, distances, indexes
-            result, indexes = self._build_nn(source_values, distances, indexes)
-            weights = distances
-        else:
-            # return distances, weights, indexes
-            result, weights, indexes = self._build_weights(source_values, distances, indexes, self.nnear)
+    def _region_indexes(self, sourcelons, sourcelats, cap):
+        """
+        Source points in the spherical cap of target points, padded by _REGION_PADDING grid spacings.
+        Returns their indexes and a mask of those far enough from the cap border to have their nearest
+        source point in the cap, or (None, None) if the padded cap covers the whole sphere.
+        """
+        center, radius = cap
+        padding = _REGION_PADDING * pi / self.geodetic_info.get('Nj')
+        if radius + padding >= pi:
+            return None, None
+        center_lat, center_lon = np.arcsin(center[2]), np.arctan2(center[1], center[0])
+        sin_clat, cos_clat = np.sin(center_lat), np.cos(center_lat)
+        lats = np.radians(np.ravel(sourcelats))
+        lons = np.radians(np.ravel(sourcelons))
+        # cosine of angular distance of source points from center
+        cos_distances = ne.evaluate('sin(lats) * sin_clat + cos(lats) * cos_clat * cos(lons - center_lon)')
+        source_indexes = np.flatnonzero(cos_distances >= np.cos(radius + padding))
+        if source_indexes.size < self.nnear:
+            return None, None
+        interior = cos_distances[source_indexes] >= np.cos(radius + padding / 2)
+        return source_indexes, interior
+
+    def _max_neighbour_distance(self, tree, sample_mask=None):
+        # largest distance between a source point and its nearest source point
+        grid = self.geodetic_info
+        if grid.get('gridType') in ('regular_ll', 'rotated_ll') and grid.is_defined('latitudeOfFirstGridPointInDegrees'):
+            # from grid geometry: nearest point is along the row or on the next row
+            ni, nj = grid.get('Ni'), grid.get('Nj')
+            lat_first = grid.get('latitudeOfFirstGridPointInDegrees')
+            lat_last = grid.get('latitudeOfLastGridPointInDegrees')
+            lon_first = grid.get('longitudeOfFirstGridPointInDegrees')
+            lon_last = grid.get('longitudeOfLastGridPointInDegrees')
+            if lon_last < lon_first:
+                lon_last += 360
+            r = grid.get('radius')
+            row_lats = np.radians(np.linspace(lat_first, lat_last, nj))
+            along_rows = 2 * r * np.cos(row_lats) * np.sin(np.radians(lon_last - lon_first) / (ni - 1) / 2) if ni > 1 else np.inf
+            across_rows = 2 * r * np.sin(np.radians(abs(lat_last - lat_first)) / (nj - 1) / 2) if nj > 1 else np.inf
+            return np.max(np.minimum(along_rows, across_rows))
+        # from a strided sample of source points (if given, only those in sample_mask)
+        data = tree.data if sample_mask is None or not np.any(sample_mask) else tree.data[sample_mask]
+        step = max(1, data.shape[0] // _BOUND_SAMPLES)
+        distances, _ = tree.query(data[::step], k=2, n_jobs=self.njobs)
+        return np.max(distances)
 
-        stdout.write('End scipy interpolation: {}\n'.format(now_string()))
+    @property
+    def _bytes_per_point(self):
+        return _BYTES_PER_POINT + _BYTES_PER_NEIGHBOUR * self.nnear
+
+    def _query_tiles(self, target):
+        # Target coordinates are rotated coords with rotated_target
+        # Examples of target rotated coords are COSMO lat/lon/dem PCRASTER maps
+        if self.prune_source:
+            region_key = '{}{}'.format(target.fingerprint[:12], '_rotated' if self.target_grid_is_rotated else '')
+            self.tree, self.min_upper_bound, self.source_indexes = self._get_tree(
+                self._sourcelons, self._sourcelats, self._store,
+                region=(region_key, partial(self._target_cap, target)))
+        valid, _ = target.valid(self._mv_target)
+        num_points = target.size
+        for start, stop in tiles(num_points, self.memory_budget, self._bytes_per_point):
+            with self.instrumentation.phase(TRANSFORM, points=stop - start):
+                target_locations = self._target_locations(target, slice(start, stop))
+            with self.instrumentation.phase(QUERY, points=stop - start, nnear=self.nnear):
+                distances, indexes = self.tree.query(target_locations, k=self.nnear, n_jobs=self.njobs)
+                if self.source_indexes is not None:
+                    # back to indexes of the whole source grid
+                    indexes = self.source_indexes[indexes]
+                # target points with invalid coordinates are out of grid
+                distances[~valid[start:stop]] = np.inf
+            yield start, stop, distances, indexes
+            self.instrumentation.progress(QUERY, stop, num_points)
+
+    def interpolate(self, source_values, target_lons, target_lats=None):
+        z = np.asarray(source_values)
+        target = as_target_grid(target_lons, target_lats)
+        num_points = target.size
+        result = empty((num_points,) + np.shape(z[0]), self._mv_target)
+        indexes = np.empty((num_points,) if self.nnear == 1 else (num_points, self.nnear), dtype=np.int64)
+        weights = np.empty(indexes.shape)
+        for start, stop, tile_distances, tile_indexes in self._query_tiles(target):
+            with self.instrumentation.phase(WEIGHTS, points=stop - start) as info:
+                if self.nnear == 1:
+                    # return distances, distances, indexes
+                    result[start:stop], indexes[start:stop], info['outs'] = self._build_nn(z, tile_distances,
+                                                                                           tile_indexes)
+                    weights[start:stop] = tile_distances
+                else:
+                    # return distances, weights, indexes
+                    (result[start:stop], weights[start:stop],
+                     indexes[start:stop], info['outs']) = self._build_weights(z, tile_distances, tile_indexes,
+                                                                              self.nnear)
         return result, indexes, weights
 
+    def table(self, target_lons, target_lats=None):
+        """
+        Returns flat positions of target points inside source grid (n,), their source indexes (n, nnear)
+        and weights (n, nnear). Results of each tile are written straight into preallocated arrays
+        with the dtypes of intertables (int32 positions and indexes, float32 weights).
+        """
+        target = as_target_grid(target_lons, target_lats)
+        num_points = target.size
+        positions = np.empty(num_points, dtype=np.int32)
+        indexes = np.empty((num_points, self.nnear), dtype=np.int32)
+        weights = np.empty((num_points, self.nnear), dtype=np.float32)
+        count = 0
+        for start, stop, tile_distances, tile_indexes in self._query_tiles(target):
+            with self.instrumentation.phase(WEIGHTS, points=stop - start) as info:
+                if self.nnear == 1:
+                    tile_indexes = self._nearest_indexes(tile_distances, tile_indexes, self.n_source)[0][:, np.newaxis]
+                    tile_weights = 1.
+                else:
+                    tile_weights, tile_indexes = self._inverse_distance_weights(tile_distances, tile_indexes,
+                                                                                self.n_source)[:2]
+                inside = tile_indexes[:, 0] != self.n_source
+                num_inside = np.count_nonzero(inside)
+                info['outs'] = stop - start - num_inside
+                positions[count:count + num_inside] = start + np.flatnonzero(inside)
+                indexes[count:count + num_inside] = tile_indexes[inside]
+                weights[count:count + num_inside] = tile_weights if self.nnear == 1 else tile_weights[inside]
+                count += num_inside
+        return shrink(positions, count), shrink(indexes, count), shrink(weights, count)
+
     def to_3d(self, lons, lats, rotate=False, to_regular=False):
+        # to_regular: from coordinates in the frame of rotated source grid to geographic ones (on the sphere)
+        # rotate: from geographic coordinates to unit vectors in the frame of rotated source grid
+        if rotate and not to_regular:
+            variables = {'lons': np.radians(lons), 'lats': np.radians(lats),
+                         'teta': radians(90 + self._south_pole[0]), 'fi': radians(self._south_pole[1])}
+            return tuple(ne.evaluate(formula, local_dict=variables) for formula in TO_ROTATED_FORMULAS)
+        return to_3d(lons, lats, self.geodetic_info.get('radius'), self._south_pole if to_regular else None)
 
-        lons = np.radians(lons)
-        lats = np.radians(lats)
-        x_formula = 'cos(lons) * cos(lats)'
-        y_formula = 'sin(lons) * cos(lats)'
-        z_formula = 'sin(lats)'
-
-        if to_regular:
-            teta = - radians((90 + self.geodetic_info.get('latitudeOfSouthernPoleInDegrees')))
-            fi = - radians(self.geodetic_info.get('longitudeOfSouthernPoleInDegrees'))
-            x = ne.evaluate('(cos(teta) * cos(fi) * ({x})) + (sin(fi)  * ({y})) + (sin(teta) * cos(fi) * ({z}))'.format(x=x_formula, y=y_formula, z=z_formula))
-            y = ne.evaluate('(cos(teta) * sin(fi) * ({x})) + (cos(fi)  * ({y})) - (sin(teta) * sin(fi) * ({z}))'.format(x=x_formula, y=y_formula, z=z_formula))
-            z = ne.evaluate('(-sin(teta) * ({x})) + (cos(teta) * ({z}))'.format(x=x_formula, z=z_formula))
-        elif rotate:
-            teta = radians((90 + self.geodetic_info.get('latitudeOfSouthernPoleInDegrees')))
-            fi = radians(self.geodetic_info.get('longitudeOfSouthernPoleInDegrees'))
-            x = ne.evaluate('(cos(teta) * cos(fi) * ({x})) + (cos(teta) * sin(fi) * ({y})) + (sin(teta) * ({z}))'.format(x=x_formula, y=y_formula, z=z_formula))
-            y = ne.evaluate('(-sin(fi) * ({x})) + (cos(fi) * ({y}))'.format(x=x_formula, y=y_formula))
-            z = ne.evaluate('(-sin(teta) * cos(fi) * ({x})) - (sin(teta) * sin(fi) * ({y})) + (cos(teta) * ({z}))'.format(x=x_formula, y=y_formula, z=z_formula))
-        else:
-            r = self.geodetic_info.get('radius')
-            x = ne.evaluate('r * {x}'.format(x=x_formula))
-            y = ne.evaluate('r * {y}'.format(y=y_formula))
-            z = ne.evaluate('r * {z}'.format(z=z_formula))
-        return x, y, z
+    def _nearest_indexes(self, distances, indexes, n_source):
+        # target points too far from any source point are out of grid (index n_source)
+        within = distances <= self.min_upper_bound
+        return np.where(within, indexes, n_source).astype(np.int64), within
 
     def _build_nn(self, z, distances, indexes):
-        z = mask_it(z, self._mv_source)
-        # TODO probably we don't need to mask but just an empty array
-        result = mask_it(np.empty((len(distances),) + np.shape(z[0])), self._mv_target, 1)
-        jinterpol = 0
+        z = np.asarray(z)
+        result = empty((len(distances),) + np.shape(z[0]), self._mv_target)
         num_cells = result.size
-        back_char, progress_step = progress_step_and_backchar(num_cells)
-
-        stdout.write('{}Building coeffs: 0/{} [outs: 0] (0%)'.format(back_char, num_cells))
-        stdout.flush()
-        idxs = empty((len(indexes),), fill_value=z.size, dtype=np.int64)
-        # wsum will be saved in intertable
-        outs = 0
-        for dist, ix in izip(distances, indexes):
-            if jinterpol % progress_step == 0:
-                stdout.write('{}Building coeffs: {}/{} [outs: {}] ({:.2f}%)'.format(back_char, jinterpol, num_cells, outs, jinterpol * 100. / num_cells))
-                stdout.flush()
-            if dist <= self.min_upper_bound:
-                wz = z[ix]
-                idxs[jinterpol] = ix
-            else:
-                outs += 1
-                wz = self._mv_target
-            result[jinterpol] = wz
-            jinterpol += 1
-        stdout.write('{}{:>100}'.format(back_char, ' '))
-        stdout.write('{}Building coeffs: {}/{} [outs: {}] (100%)\n'.format(back_char, jinterpol, num_cells, outs))
-        stdout.flush()
-        return result, idxs
+        idxs, within = self._nearest_indexes(distances, indexes, z.size)
+        outs = num_cells - np.count_nonzero(within)
+        result[within] = z[indexes[within]]
+        return result, idxs, outs
 
-    def _build_weights(self, z, distances, indexes, nnear):
+    def _inverse_distance_weights(self, distances, indexes, n_source):
+        nnear = self.nnear
+        # exact hits take exactly the source point (weight = 1),
+        # target points too far from any source point are out of grid (index n_source)
+        exact = distances[:, 0] <= 1e-10
+        within = ~exact & (distances[:, 0] <= self.min_upper_bound)
 
-        # TODO CHECK: maybe we don't need to mask here
-        z = mask_it(z, self._mv_source)
-        # no intertable found for inverse distance nnear = 8
-        # TODO CHECK if we need mask here (maybe just need an empty array)
-        result = mask_it(np.empty((len(distances),) + np.shape(z[0])), self._mv_target, 1)
-        jinterpol = 0
-        num_cells = result.size
+        # weights will be saved in intertable along with indexes
+        weights = np.zeros((len(distances), nnear))
+        weights[:, 0] = 1.
+        idxs = empty((len(indexes),) + (nnear,), fill_value=n_source, dtype=int)
+        idxs[exact] = indexes[exact]
+        idxs[within] = indexes[within]
 
-        back_char, progress_step = progress_step_and_backchar(num_cells)
+        dist = distances[within]
+        w = ne.evaluate('1 / dist ** 2')
+        # summing columns one by one keeps the same order of operations of a per-point sum
+        sums = w[:, 0].copy()
+        for k in xrange(1, nnear):
+            sums += w[:, k]
+        sums = sums[:, np.newaxis]
+        ne.evaluate('w / sums', out=w)
+        weights[within] = w
+        return weights, idxs, exact, within, w
 
-        stdout.write('{}Building coeffs: 0/{} [outs: 0] (0%)'.format(back_char, num_cells))
-        stdout.flush()
-        # weights will be saved in intertable along with indexes
-        weights = empty((len(distances),) + (nnear,))
-        idxs = empty((len(indexes),) + (nnear,), fill_value=z.size, dtype=int)
-        empty_array = empty(z[0].shape, self._mv_target)
-        outs = 0
-        for dist, ix in izip(distances, indexes):
-            if jinterpol % progress_step == 0:
-                stdout.write('{}Building coeffs: {}/{} [outs: {}] ({:.2f}%)'.format(back_char, jinterpol, num_cells, outs, jinterpol * 100. / num_cells))
-                stdout.flush()
-            if dist[0] <= 1e-10:
-                wz = z[ix[0]]  # take exactly the point, weight = 1
-                idxs[jinterpol] = ix
-                weights[jinterpol] = np.array([1., 0., 0., 0.])
-            elif dist[0] <= self.min_upper_bound:
-                w = ne.evaluate('1 / dist ** 2')
-                sums = ne.evaluate('sum(w)')
-                ne.evaluate('w/sums', out=w)
-                wz = np.dot(w, z[ix])  # weighted values (result)
-                weights[jinterpol] = w
-                idxs[jinterpol] = ix
-            else:
-                outs += 1
-                weights[jinterpol] = np.array([1., 0., 0., 0.])
-                wz = empty_array
-            result[jinterpol] = wz
-            jinterpol += 1
-        stdout.write('{}{:>100}'.format(back_char, ' '))
-        stdout.write('{}Building coeffs: {}/{} [outs: {}] (100%)\n'.format(back_char, jinterpol, num_cells, outs))
-        stdout.flush()
-        return result, weights, idxs
+    def _build_weights(self, z, distances, indexes, nnear):
+        z = np.asarray(z)
+        result = empty((len(distances),) + np.shape(z[0]), self._mv_target)
+        num_cells = result.size
+        weights, idxs, exact, within, w = self._inverse_distance_weights(distances, indexes, z.size)
+        outs = num_cells - np.count_nonzero(exact) - np.count_nonzero(within)
+
+        result[exact] = z[indexes[exact, 0]]
+        zw = z[indexes[within]]
+        wz = w[:, 0] * zw[:, 0]
+        for k in xrange(1, nnear):
+            wz += w[:, k] * zw[:, k]
+        result[within] = wz
+        return result, weights, idxs, outs
@@ -0,0 +1,106 @@
+"""
+This software comes as Open Source and licensed via AGPL v3.
+It was developed under the initiative Copernicus, EFAS operational center @ECMWF (Reading, UK).
+
+Synthetic source grids generated in memory, with a stand-in for GribGridDetails,
+so that interpolators can be built and run without GRIB data (tests and benchmark.py).
+"""
+
+import numpy as np
+
+RADIUS = 6367470.
+
+
+class SyntheticGridDetails(object):
+    """
+    Stand-in for GribGridDetails of a synthetic grid: geo keys as they are read from GRIB messages,
+    lats and lons of grid points.
+    """
+
+    def __init__(self, grid_type, lats, lons, grid_id, **keys):
+        self.lats = np.ravel(lats)
+        self.lons = np.ravel(lons)
+        self._geo_keys = {'gridType': grid_type, 'radius': RADIUS, 'numberOfValues': self.lats.size,
+                          'missingValue': 9999.}
+        self._geo_keys.update(keys)
+        self.grid_id = grid_id
+
+    def get(self, geo_key):
+        return self._geo_keys[geo_key]
+
+    def is_defined(self, geo_key):
+        return geo_key in self._geo_keys
+
+    @property
+    def latlons(self):
+        return self.lats, self.lons
+
+    @property
+    def num_points_along_meridian(self):
+        return self._geo_keys['Nj']
+
+    def get_2nd_resolution(self):
+        return None
+
+
+def _latlon_keys(lat_first, lat_last, nj, lon_first, lon_last, ni):
+    return {'Ni': ni, 'Nj': nj, 'latitudeOfFirstGridPointInDegrees': lat_first,
+            'latitudeOfLastGridPointInDegrees': lat_last, 'longitudeOfFirstGridPointInDegrees': lon_first,
+            'longitudeOfLastGridPointInDegrees': lon_last}
+
+
+def regular_grid(lat_first, lat_last, nj, lon_first, lon_last, ni, grid_type='regular_ll', **keys):
+    """
+    Grid of nj equally spaced rows of ni equally spaced points.
+    With grid_type='rotated_ll', coordinates are in the rotated frame (see rotate_to_geographic)
+    and south pole keys are given as keys.
+    """
+    lons, lats = np.meshgrid(np.linspace(lon_first, lon_last, ni), np.linspace(lat_first, lat_last, nj))
+    keys.update(_latlon_keys(lat_first, lat_last, nj, lon_first, lon_last, ni))
+    grid_id = '{}${}${}${}${}'.format(lon_first, lon_last, ni, nj, grid_type)
+    return SyntheticGridDetails(grid_type, lats, lons, grid_id, **keys)
+
+
+def rotated_grid(lat_first, lat_last, nj, lon_first, lon_last, ni, south_pole_lat, south_pole_lon):
+    # rotated_ll grid with geographic coordinates
+    grid = regular_grid(lat_first, lat_last, nj, lon_first, lon_last, ni, grid_type='rotated_ll',
+                        latitudeOfSouthernPoleInDegrees=south_pole_lat,
+                        longitudeOfSouthernPoleInDegrees=south_pole_lon)
+    grid.lats, grid.lons = rotate_to_geographic(grid.lats, grid.lons, south_pole_lat, south_pole_lon)
+    return grid
+
+
+def _gaussian_latitudes(n):
+    # 2n gaussian latitudes, north to south
+    x, _ = np.polynomial.legendre.leggauss(2 * n)
+    return np.degrees(np.arcsin(x))[::-1]
+
+
+def gaussian_grid(n):
+    # regular_gg grid with n rows between a pole and the equator
+    row_lats = _gaussian_latitudes(n)
+    ni = 4 * n
+    lons, lats = np.meshgrid(np.arange(ni) * 360. / ni, row_lats)
+    keys = _latlon_keys(row_lats[0], row_lats[-1], 2 * n, 0., 360. - 360. / ni, ni)
+    return SyntheticGridDetails('regular_gg', lats, lons, 'F{}'.format(n), **keys)
+
+
+def octahedral_grid(n):
+    # reduced_gg grid with 20 + 4 * i points on the i-th row from a pole
+    row_lats = _gaussian_latitudes(n)
+    pl = np.concatenate((20 + 4 * np.arange(n), (20 + 4 * np.arange(n))[::-1]))
+    lats = np.repeat(row_lats, pl)
+    lons = np.concatenate([np.arange(points) * 360. / points for points in pl])
+    return SyntheticGridDetails('reduced_gg', lats, lons, 'O{}'.format(n), Nj=2 * n)
+
+
+def rotate_to_geographic(lats, lons, south_pole_lat, south_pole_lon):
+    # inverse of analyticlib.rotate_to_grid
+    teta = np.radians(90 + south_pole_lat)
+    fi = np.radians(south_pole_lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    x, y, z = np.cos(lons) * np.cos(lats), np.sin(lons) * np.cos(lats), np.sin(lats)
+    x_geo = np.cos(teta) * np.cos(fi) * x - np.sin(fi) * y - np.sin(teta) * np.cos(fi) * z
+    y_geo = np.cos(teta) * np.sin(fi) * x + np.cos(fi) * y - np.sin(teta) * np.sin(fi) * z
+    z_geo = np.sin(teta) * x + np.cos(teta) * z
+    return np.degrees(np.arcsin(z_geo)), np.degrees(np.arctan2(y_geo, x_geo))
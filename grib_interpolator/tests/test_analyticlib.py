@@ -0,0 +1,78 @@
+import unittest
+
+import numpy as np
+
+from grib_interpolator.analyticlib import (analytic_nearest, analytic_invdist, angular_distance, rotate_to_grid)
+from grib_interpolator.synthetic import regular_grid, octahedral_grid, rotate_to_geographic
+
+
+class TestAnalytic(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.grid = regular_grid(89.5, -89.5, 180, 0., 358., 180)
+        random = np.random.RandomState(0)
+        cls.target_lats = random.uniform(-89, 89, (20, 30))
+        cls.target_lons = random.uniform(-180, 180, (20, 30))
+
+    def test_nearest_global(self):
+        positions, idxs = analytic_nearest(self.grid, self.grid.lats, self.grid.lons,
+                                           self.target_lats, self.target_lons, -1)
+        self.assertEqual(positions.size, self.target_lats.size)
+        distances = angular_distance(self.target_lats.ravel()[:, np.newaxis], self.target_lons.ravel()[:, np.newaxis],
+                                     self.grid.lats[np.newaxis], self.grid.lons[np.newaxis])
+        expected = np.argmin(distances, axis=1)
+        np.testing.assert_array_equal(idxs, expected)
+
+    def test_invdist_global(self):
+        target_lats = self.target_lats.copy()
+        target_lons = self.target_lons.copy()
+        target_lats[0, 0], target_lons[0, 0] = self.grid.lats[1000], self.grid.lons[1000]
+        positions, idxs, coeffs = analytic_invdist(self.grid, self.grid.lats, self.grid.lons,
+                                                   target_lats, target_lons, -1)
+        np.testing.assert_allclose(coeffs.sum(axis=1), 1)
+        self.assertEqual(idxs[0, 0], 1000)
+        np.testing.assert_array_equal(coeffs[0], [1, 0, 0, 0])
+
+    def test_limited_area(self):
+        grid = regular_grid(60., 40., 21, -10., 30., 41)
+        target_lats = np.array([[50.5, 70.], [40., 45.]])
+        target_lons = np.array([[0.5, 0.], [30., 31.]])
+        positions, idxs = analytic_nearest(grid, grid.lats, grid.lons, target_lats, target_lons, -1)
+        np.testing.assert_array_equal(positions, [0, 2])
+
+    def test_rotated(self):
+        south_pole_lat, south_pole_lon = -40., 10.
+        grid = regular_grid(-5., 5., 11, -5., 5., 11, grid_type='rotated_ll',
+                            latitudeOfSouthernPoleInDegrees=south_pole_lat,
+                            longitudeOfSouthernPoleInDegrees=south_pole_lon)
+        lats, lons = rotate_to_geographic(grid.lats, grid.lons, south_pole_lat, south_pole_lon)
+        rotated_lats, rotated_lons = rotate_to_grid(lats, lons, south_pole_lat, south_pole_lon)
+        np.testing.assert_allclose(rotated_lats, grid.lats, atol=1e-9)
+        np.testing.assert_allclose(rotated_lons, grid.lons, atol=1e-9)
+        positions, idxs = analytic_nearest(grid, lats, lons, lats.reshape(11, 11), lons.reshape(11, 11), -1)
+        np.testing.assert_array_equal(idxs, np.arange(121))
+
+    def test_octahedral(self):
+        grid = octahedral_grid(32)
+        positions, idxs = analytic_nearest(grid, grid.lats, grid.lons, self.target_lats, self.target_lons, -1)
+        distances = angular_distance(self.target_lats.ravel()[:, np.newaxis], self.target_lons.ravel()[:, np.newaxis],
+                                     grid.lats[np.newaxis], grid.lons[np.newaxis])
+        np.testing.assert_array_equal(idxs, np.argmin(distances, axis=1))
+        positions, idxs, coeffs = analytic_invdist(grid, grid.lats, grid.lons, self.target_lats, self.target_lons, -1)
+        self.assertEqual(idxs.shape, (self.target_lats.size, 4))
+        np.testing.assert_allclose(coeffs.sum(axis=1), 1)
+
+    def test_memory_budget(self):
+        # limited area grid: tiles have target points out of grid
+        grid = regular_grid(60., 20., 41, -10., 30., 41)
+        random = np.random.RandomState(1)
+        target_lats = random.uniform(10, 70, (50, 70))
+        target_lons = random.uniform(-20, 40, (50, 70))
+        target_lons[0, :10] = -1.0e+20
+        for function in (analytic_nearest, analytic_invdist):
+            expected = function(grid, grid.lats, grid.lons, target_lats, target_lons, -1)
+            # tiles of 1000 points
+            result = function(grid, grid.lats, grid.lons, target_lats, target_lons, -1, memory_budget=1)
+            for expected_array, array in zip(expected, result):
+                np.testing.assert_array_equal(array, expected_array)
@@ -0,0 +1,194 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from grib_interpolator.base import Interpolator, FLOAT32_ERROR_BOUND
+from grib_interpolator.instrumentation import logger
+from grib_interpolator.intertables import IntertablesCache
+from grib_interpolator.models import TargetGrid
+from grib_interpolator.utils import open_output_cube
+from grib_interpolator.synthetic import regular_grid
+from grib_interpolator.tests.test_instrumentation import ListHandler
+
+
+class _AnalyticTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.grid = regular_grid(60., 30., 31, -10., 30., 41)
+        random = np.random.RandomState(0)
+        cls.target_lats = random.uniform(31, 59, (15, 20))
+        cls.target_lons = random.uniform(-9, 29, (15, 20))
+        cls.target_lons[0, 0] = -1.0e+20  # invalid target point
+        cls.members = random.normal(280, 5, (51, cls.grid.lats.size))
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _interpolator(self, mode, **kwargs):
+        kwargs.setdefault('target_mv', -1)
+        kwargs.setdefault('store', self.tmp_dir)
+        return Interpolator(self.grid.lats, self.grid.lons, self.grid, mode=mode, method='analytic', **kwargs)
+
+
+class TestStatistics(_AnalyticTestCase):
+
+    def test_mean_is_exact(self):
+        interpolator = self._interpolator('invdist')
+        stats = interpolator.interpolate_statistics(self.members, self.target_lons, self.target_lats, ('mean',))
+        members = interpolator.interpolate_many(self.members, self.target_lons, self.target_lats)
+        np.testing.assert_allclose(stats['mean'], members.mean(axis=0), rtol=1e-12)
+        self.assertIs(stats['mean'][0, 0], np.ma.masked)
+
+    def test_nearest_is_exact(self):
+        interpolator = self._interpolator('nearest')
+        statistics = ('mean', 'min', 'max', 'std', ('quantile', .9), ('probability', 285.))
+        stats = interpolator.interpolate_statistics(self.members, self.target_lons, self.target_lats, statistics)
+        members = interpolator.interpolate_many(self.members, self.target_lons, self.target_lats)
+        expected = {'mean': members.mean(axis=0), 'min': members.min(axis=0), 'max': members.max(axis=0),
+                    'std': members.std(axis=0), ('quantile', .9): np.percentile(members.data, 90, axis=0),
+                    ('probability', 285.): np.mean(members.data > 285., axis=0)}
+        for statistic in statistics:
+            np.testing.assert_allclose(stats[statistic][1:], expected[statistic][1:], rtol=1e-12)
+
+    def test_nonlinear_statistics_warning(self):
+        handler = ListHandler()
+        logger.addHandler(handler)
+        try:
+            interpolator = self._interpolator('invdist')
+            stats = interpolator.interpolate_statistics(self.members, self.target_lons, self.target_lats)
+            self.assertEqual(stats.keys(), ['mean'])
+            self.assertEqual(handler.messages, [])
+            interpolator.interpolate_statistics(self.members, self.target_lons, self.target_lats, ('mean', 'std'))
+            self.assertEqual(len(handler.messages), 1)
+            self.assertIn("['std']", handler.messages[0])
+            self._interpolator('nearest').interpolate_statistics(self.members, self.target_lons, self.target_lats,
+                                                                 ('mean', 'std'))
+            self.assertEqual(len(handler.messages), 1)
+        finally:
+            logger.removeHandler(handler)
+
+    def test_unknown_statistic(self):
+        interpolator = self._interpolator('nearest')
+        self.assertRaises(ValueError, interpolator.interpolate_statistics, self.members,
+                          self.target_lons, self.target_lats, ('spread',))
+
+
+class TestOutput(_AnalyticTestCase):
+
+    def test_plain_arrays(self):
+        interpolator = self._interpolator('invdist', masked=False, target_mv=np.nan)
+        for i in range(2):
+            # intertable is created, then used
+            result = interpolator.interpolate(self.members[0], self.target_lons, self.target_lats)
+            self.assertIs(type(result), np.ndarray)
+            self.assertTrue(np.isnan(result[0, 0]))
+            self.assertEqual(np.count_nonzero(np.isnan(result)), 1)
+        results = interpolator.interpolate_many(self.members[:3], self.target_lons, self.target_lats)
+        self.assertIs(type(results), np.ndarray)
+        np.testing.assert_array_equal(results[0], result)
+
+    def test_masked_arrays(self):
+        interpolator = self._interpolator('nearest')
+        first = interpolator.interpolate(self.members[0], self.target_lons, self.target_lats)
+        second = interpolator.interpolate(self.members[1], self.target_lons, self.target_lats)
+        self.assertEqual(np.count_nonzero(second.mask), 1)
+        # results can be modified independently
+        second[0, 0] = 1
+        self.assertIs(first[0, 0], np.ma.masked)
+        results = interpolator.interpolate_many(self.members[:3], self.target_lons, self.target_lats)
+        self.assertEqual(np.count_nonzero(results.mask), 3)
+
+    def test_output_cube(self):
+        interpolator = self._interpolator('invdist', masked=False)
+        expected = interpolator.interpolate_many(self.members[:4], self.target_lons, self.target_lats)
+        interpolator = self._interpolator('invdist', masked=False, store=self.tmp_dir + '/other')
+        cube = open_output_cube(self.tmp_dir + '/cube.npy', 4, self.target_lons.shape)
+        for i in range(2):
+            # intertable is created at first step
+            result = interpolator.interpolate(self.members[i], self.target_lons, self.target_lats, out=cube[i])
+            self.assertTrue(np.shares_memory(result, cube))
+        interpolator.interpolate_many(self.members[2:4], self.target_lons, self.target_lats, out=cube[2:4])
+        cube.flush()
+        np.testing.assert_allclose(np.load(self.tmp_dir + '/cube.npy'), expected, rtol=1e-12)
+
+    def test_float32(self):
+        members = self.members[:5]
+        for mode, nnear in (('nearest', 1), ('invdist', 4)):
+            expected = self._interpolator(mode, masked=False).interpolate_many(members, self.target_lons,
+                                                                             self.target_lats)
+            interpolator = self._interpolator(mode, masked=False, dtype=np.float32)
+            result = interpolator.interpolate(members[0], self.target_lons, self.target_lats)
+            self.assertEqual(result.dtype, np.float32)
+            results = interpolator.interpolate_many(members, self.target_lons, self.target_lats)
+            self.assertEqual(results.dtype, np.float32)
+            np.testing.assert_array_equal(results[0], result)
+            bound = FLOAT32_ERROR_BOUND * (nnear + 2) * np.max(np.abs(members))
+            self.assertLess(np.max(np.abs(results - expected)), bound)
+
+
+class TestTargetGrid(_AnalyticTestCase):
+
+    def test_same_results(self):
+        target = TargetGrid(self.target_lats, self.target_lons)
+        for mode in ('nearest', 'invdist'):
+            interpolator = self._interpolator(mode, masked=False)
+            self.assertEqual(interpolator.get_intertable_path(target),
+                             interpolator.get_intertable_path(self.target_lons, self.target_lats))
+            # intertable is built from TargetGrid
+            result = interpolator.interpolate(self.members[0], target)
+            expected = interpolator.interpolate(self.members[0], self.target_lons, self.target_lats)
+            np.testing.assert_array_equal(result, expected)
+            np.testing.assert_array_equal(interpolator.interpolate_many(self.members[:3], target)[0], expected)
+
+    def test_shapes(self):
+        self.assertRaises(ValueError, TargetGrid, self.target_lats, self.target_lons[:5])
+
+
+class TestLegacyIntertables(_AnalyticTestCase):
+
+    def test_explicit_conversion(self):
+        grid = regular_grid(60., 30., 31, -10., 30., 41)
+        interpolator = Interpolator(grid.lats, grid.lons, grid, mode='nearest', method='scipy', store=self.tmp_dir,
+                                    masked=False, cache=IntertablesCache())
+        target_lats, target_lons = self.target_lats[1:4, 1:5], self.target_lons[1:4, 1:5]
+        # legacy table of a 3x4 target taking source point 0 everywhere
+        np.save(interpolator.legacy_intertable_path, np.rec.fromarrays((np.zeros(12, dtype=int),), names=('indexes',)))
+        values = np.arange(grid.lats.size, dtype=float)
+        # never used as it is
+        self.assertNotEqual(np.count_nonzero(interpolator.interpolate(values, target_lons, target_lats)), 0)
+        os.remove(interpolator.intertable_path)
+        interpolator.cache.clear()
+        self.assertRaises(ValueError, interpolator.convert_legacy_intertable, self.target_lons[:4, :4],
+                          self.target_lats[:4, :4])
+        path = interpolator.convert_legacy_intertable(target_lons, target_lats)
+        self.assertEqual(path, interpolator.get_intertable_path(target_lons, target_lats))
+        np.testing.assert_array_equal(interpolator.interpolate(values, target_lons, target_lats), np.zeros((3, 4)))
+
+    def test_warning_before_build(self):
+        grid = regular_grid(60., 30., 31, -10., 30., 41)
+        interpolator = Interpolator(grid.lats, grid.lons, grid, mode='nearest', method='scipy', store=self.tmp_dir,
+                                    cache=IntertablesCache())
+        values = np.arange(grid.lats.size, dtype=float)
+        handler = ListHandler()
+        logger.addHandler(handler)
+        try:
+            interpolator.interpolate(values, self.target_lons, self.target_lats)
+            self.assertEqual(handler.messages, [])
+            os.remove(interpolator.intertable_path)
+            np.save(interpolator.legacy_intertable_path, np.zeros(3))
+            interpolator.interpolate(values, self.target_lons, self.target_lats)
+            self.assertEqual(len(handler.messages), 1)
+            self.assertIn(interpolator.legacy_intertable_path, handler.messages[0])
+            self.assertIn('convert_legacy_intertable', handler.messages[0])
+            # no warning once the intertable is in the store
+            interpolator.interpolate(values, self.target_lons, self.target_lats)
+            self.assertEqual(len(handler.messages), 1)
+        finally:
+            logger.removeHandler(handler)
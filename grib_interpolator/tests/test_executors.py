@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from grib_interpolator.executors import SerialExecutor, ProcessPoolExecutor, Checkpoint
+
+
+class SquareJob(object):
+
+    def __init__(self, values):
+        self.values = values
+
+    def __call__(self, start, stop):
+        return self.values[start:stop] ** 2
+
+
+class TestExecutors(unittest.TestCase):
+
+    def _check(self, executor):
+        values = np.arange(1000, dtype=np.int64)
+        result = np.empty(values.size, dtype=np.int64)
+        for start, stop, chunk_result in executor.map_chunks(SquareJob(values), values.size):
+            result[start:stop] = chunk_result
+        np.testing.assert_array_equal(result, values ** 2)
+        self.assertEqual(sum(timing.size for timing in executor.timings), values.size)
+        self.assertEqual(len(executor.timings), 10)
+
+    def test_serial(self):
+        self._check(SerialExecutor(chunk_size=100))
+
+    def test_process_pool(self):
+        self._check(ProcessPoolExecutor(workers=2, chunk_size=100))
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.work_dir = os.path.join(self.tmp_dir, 'table.itab.work')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_resume(self):
+        values = np.arange(1000, dtype=np.int64)
+        executor = SerialExecutor(chunk_size=100)
+        chunks = executor.map_chunks(SquareJob(values), values.size, checkpoint=Checkpoint(self.work_dir, 'key'))
+        for _ in range(3):
+            next(chunks)
+        chunks.close()  # build interrupted after three chunks
+
+        executor = SerialExecutor(chunk_size=100)
+        result = np.empty(values.size, dtype=np.int64)
+        for start, stop, chunk_result in executor.map_chunks(SquareJob(values), values.size,
+                                                             checkpoint=Checkpoint(self.work_dir, 'key')):
+            result[start:stop] = chunk_result
+        np.testing.assert_array_equal(result, values ** 2)
+        self.assertEqual(len(executor.timings), 7)
+
+    def test_other_build(self):
+        checkpoint = Checkpoint(self.work_dir, 'key')
+        checkpoint.save(0, 10, np.arange(10))
+        self.assertEqual(Checkpoint(self.work_dir, 'key').completed(), {(0, 10)})
+        self.assertEqual(Checkpoint(self.work_dir, 'other key').completed(), set())
+
+    def test_missing_or_truncated_meta(self):
+        meta_path = os.path.join(self.work_dir, 'checkpoint.json')
+        for content in (None, '{"ke'):
+            Checkpoint(self.work_dir, 'key').save(0, 10, np.arange(10))
+            # build killed before its meta file was written, or while writing it
+            os.remove(meta_path)
+            if content is not None:
+                with open(meta_path, 'w') as fh:
+                    fh.write(content)
+            checkpoint = Checkpoint(self.work_dir, 'key')
+            self.assertEqual(checkpoint.completed(), set())
+            self.assertEqual(os.listdir(self.work_dir), ['checkpoint.json'])
+            with open(meta_path) as fh:
+                self.assertEqual(json.load(fh), {'key': 'key'})
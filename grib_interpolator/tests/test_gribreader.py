@@ -0,0 +1,178 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from grib_interpolator import gribreader, models
+from grib_interpolator.gribreader import GRIBReader
+from grib_interpolator.headers import HEADER_KEYS
+
+
+class FakeGribapi(object):
+    """
+    Stand-in for the gribapi functions used by GRIBReader and GribGridDetails, so that readers run without
+    GRIB data. Messages are the rows of a headers table, found at their offset; decoded values are all
+    equal to the offset. Live gids and decoded offsets are recorded.
+    """
+    reader_functions = ('grib_no_fail_on_wrong_length', 'grib_new_from_file', 'grib_release', 'grib_get',
+                        'grib_get_double_array', 'grib_is_defined')
+    models_functions = ('grib_is_defined', 'grib_is_missing', 'grib_get_string', 'grib_get_double', 'grib_get_long')
+
+    def __init__(self, headers):
+        self.rows = {row['offset']: row for row in headers}
+        # gid -> offset of messages not released yet
+        self.live = {}
+        self.decoded = []
+        self.file_handlers = []
+        self._next_gid = 1
+        self._saved = []
+
+    def install(self):
+        for module, names in ((gribreader, self.reader_functions), (models.gribapi, self.models_functions)):
+            for name in names:
+                self._saved.append((module, name, getattr(module, name)))
+                setattr(module, name, getattr(self, name))
+
+    def uninstall(self):
+        for module, name, function in self._saved:
+            setattr(module, name, function)
+
+    def grib_no_fail_on_wrong_length(self, flag):
+        pass
+
+    def grib_new_from_file(self, fh, headers_only=False):
+        offset = fh.tell()
+        if offset not in self.rows:
+            return None
+        gid = self._next_gid
+        self._next_gid += 1
+        self.live[gid] = offset
+        self.file_handlers.append(fh)
+        return gid
+
+    def grib_release(self, gid):
+        del self.live[gid]
+
+    def _keys(self, gid):
+        row = self.rows[self.live[gid]]
+        nj = int(row['Nj'])
+        keys = dict(zip(row.dtype.names, row.tolist()))
+        keys.update({'gridType': 'regular_ll', 'radius': 6367470., 'Ni': 2 * nj, 'numberOfValues': 2 * nj * nj,
+                     'longitudeOfFirstGridPointInDegrees': 0., 'longitudeOfLastGridPointInDegrees': 360. - 180. / nj,
+                     'latitudeOfFirstGridPointInDegrees': 90., 'latitudeOfLastGridPointInDegrees': -90.})
+        return keys
+
+    def grib_get(self, gid, key):
+        return self._keys(gid)[key]
+
+    grib_get_string = grib_get_double = grib_get_long = grib_get
+
+    def grib_is_defined(self, gid, key):
+        return key in self._keys(gid)
+
+    def grib_is_missing(self, gid, key):
+        return False
+
+    def grib_get_double_array(self, gid, key):
+        offset = self.live[gid]
+        self.decoded.append(offset)
+        return np.ones(self._keys(gid)['numberOfValues']) * offset
+
+
+def make_headers(messages):
+    # messages: (shortName, perturbationNumber, startStep, endStep, Nj) in file order
+    rows = [(short_name, member, 0, 'sfc', start, end, 'instant', nj, 'K', 9999., 100 * i)
+            for i, (short_name, member, start, end, nj) in enumerate(messages)]
+    return np.array(rows, dtype=list(HEADER_KEYS))
+
+
+class _FakeGribTestCase(unittest.TestCase):
+    messages = ()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.grib_file = os.path.join(self.tmp_dir, 'input.grb')
+        with open(self.grib_file, 'wb') as fh:
+            fh.write(b'\0' * 100 * len(self.messages))
+        headers = make_headers(self.messages)
+        self.gribapi = FakeGribapi(headers)
+        self.gribapi.install()
+        self.reader = GRIBReader(self.grib_file, indexes=('shortName', 'perturbationNumber'))
+        # no need to scan the file
+        self.reader._headers = headers
+
+    def tearDown(self):
+        self.reader.close()
+        self.gribapi.uninstall()
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestIterMessages(_FakeGribTestCase):
+    # end steps out of order, last two messages at second spatial resolution
+    messages = (('2t', 1, 6, 12, 32), ('2t', 1, 0, 0, 32), ('tp', 1, 0, 6, 32), ('2t', 1, 0, 6, 32),
+                ('2t', 1, 18, 24, 16), ('2t', 1, 12, 18, 16))
+
+    def test_order_and_values(self):
+        steps = []
+        for step, values in self.reader.iter_messages(shortName='2t'):
+            steps.append(step)
+            # values of the message of that step
+            self.assertTrue(np.all(values == self.gribapi.decoded[-1]))
+        self.assertEqual([step.end_step for step in steps], [0, 6, 12, 18, 24])
+        self.assertEqual(self.gribapi.decoded, [100, 300, 0, 500, 400])
+        grid2 = self.reader.grid_details.get_2nd_resolution()
+        self.assertEqual(grid2.num_points_along_meridian, 16)
+        self.assertEqual([self.reader.grid_details_for(step) is grid2 for step in steps],
+                         [False, False, False, True, True])
+
+    def test_one_decode_at_a_time(self):
+        messages = self.reader.iter_messages(shortName='2t')
+        # only messages kept for grid details are open before iterating
+        self.assertEqual(self.gribapi.decoded, [])
+        self.assertEqual(sorted(self.gribapi.live), sorted(self.reader._selected_grbs))
+        for i, _ in enumerate(messages):
+            self.assertEqual(len(self.gribapi.decoded), i + 1)
+            # each message is released right after decoding
+            self.assertEqual(sorted(self.gribapi.live), sorted(self.reader._selected_grbs))
+
+    def test_file_is_closed(self):
+        messages = self.reader.iter_messages(shortName='2t')
+        next(messages)
+        next(messages)
+        messages.close()
+        handlers = [fh for fh in self.gribapi.file_handlers if fh is not self.reader._file_handler]
+        self.assertTrue(handlers)
+        self.assertTrue(all(fh.closed for fh in handlers))
+        self.assertEqual(len(self.gribapi.decoded), 2)
+
+    def test_no_messages(self):
+        self.assertRaises(ValueError, self.reader.iter_messages, shortName='sd')
+
+
+class TestSelectGroups(_FakeGribTestCase):
+    # groups interleaved in the file, end steps out of order, last message at second spatial resolution
+    messages = (('2t', 2, 6, 12, 32), ('2t', 1, 6, 12, 32), ('tp', 1, 6, 12, 32), ('2t', 1, 0, 0, 32),
+                ('2t', 2, 0, 0, 32), ('tp', 1, 0, 6, 32), ('2t', 1, 12, 18, 16))
+
+    def test_groups(self):
+        groups = self.reader.select_groups()
+        self.assertEqual(groups.keys(), [('2t', 2, 0), ('2t', 1, 0), ('tp', 1, 0)])
+        end_steps = [[step.end_step for step in messages.first_resolution_values()] for messages in groups.values()]
+        self.assertEqual(end_steps, [[0, 12], [0, 12], [6, 12]])
+        second_res = groups['2t', 1, 0].second_resolution_values()
+        self.assertEqual([step.end_step for step in second_res], [18])
+        # values of each step come from the message of that step
+        offsets = [[int(values[0]) for values in messages.first_resolution_values().values()]
+                   for messages in groups.values()]
+        self.assertEqual(offsets, [[400, 0], [300, 100], [500, 200]])
+        self.assertEqual(int(second_res.values()[0][0]), 600)
+        # single pass over the file
+        self.assertEqual(self.gribapi.decoded, [0, 100, 200, 300, 400, 500, 600])
+        self.assertIs(groups['2t', 2, 0].grid_details, groups['tp', 1, 0].grid_details)
+        self.assertEqual(groups['2t', 1, 0].grid_details.get_2nd_resolution().num_points_along_meridian, 16)
+        self.assertEqual(sorted(self.gribapi.live), sorted(self.reader._selected_grbs))
+
+    def test_no_messages(self):
+        self.assertRaises(ValueError, self.reader.select_groups, shortName='sd')
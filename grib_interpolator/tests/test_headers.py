@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from grib_interpolator.headers import HEADER_KEYS, select, headers_index_path, save_headers, load_headers
+from grib_interpolator.utils import int_fill_value
+
+
+def make_headers():
+    rows = []
+    offset = 0
+    for short_name in ('2t', 'tp'):
+        for member in (1, 2, int_fill_value):
+            for step in (0, 6, 12, 18):
+                rows.append((short_name, member, 0, 'sfc', step, step, 'instant', 135, 'K', 9999., offset))
+                offset += 100
+    return np.array(rows, dtype=list(HEADER_KEYS))
+
+
+class TestHeadersSelection(unittest.TestCase):
+
+    def setUp(self):
+        self.headers = make_headers()
+
+    def test_values_and_containers(self):
+        mask, unresolved = select(self.headers, shortName='2t', perturbationNumber=[1, 2])
+        self.assertEqual(unresolved, {})
+        self.assertEqual(np.count_nonzero(mask), 8)
+        self.assertTrue(np.all(self.headers['shortName'][mask] == '2t'))
+
+    def test_callables_run_once_per_value(self):
+        calls = []
+
+        def end_step(s):
+            calls.append(s)
+            return s >= 6
+
+        mask, _ = select(self.headers, shortName='tp', endStep=end_step)
+        self.assertEqual(sorted(calls), [0, 6, 12, 18])
+        self.assertEqual(np.count_nonzero(mask), 9)
+
+    def test_missing_keys_are_not_selected(self):
+        mask, _ = select(self.headers, perturbationNumber=lambda p: True)
+        self.assertEqual(np.count_nonzero(mask), 16)
+
+    def test_unresolved(self):
+        mask, unresolved = select(self.headers, shortName='2t', dataDate=20130630)
+        self.assertEqual(unresolved, {'dataDate': 20130630})
+        self.assertEqual(np.count_nonzero(mask), 12)
+
+
+class TestHeadersIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.grib_file = os.path.join(self.tmp_dir, 'input.grb')
+        with open(self.grib_file, 'wb') as fh:
+            fh.write('GRIB')
+        self.headers = make_headers()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_roundtrip(self):
+        path = headers_index_path(self.grib_file)
+        self.assertEqual(path, self.grib_file + '.hidx')
+        save_headers(path, self.grib_file, self.headers)
+        np.testing.assert_array_equal(load_headers(path, self.grib_file), self.headers)
+        # keys not in index
+        self.assertIsNone(load_headers(path, self.grib_file, keys=('dataDate',)))
+
+    def test_index_dir(self):
+        index_dir = os.path.join(self.tmp_dir, 'indexes')
+        os.mkdir(index_dir)
+        path = headers_index_path(self.grib_file, index_dir)
+        self.assertEqual(os.path.dirname(path), index_dir)
+        self.assertNotEqual(path, headers_index_path(os.path.join(self.tmp_dir, 'other', 'input.grb'), index_dir))
+
+    def test_stale_index(self):
+        path = headers_index_path(self.grib_file)
+        save_headers(path, self.grib_file, self.headers)
+        with open(self.grib_file, 'ab') as fh:
+            fh.write('GRIB')
+        self.assertIsNone(load_headers(path, self.grib_file))
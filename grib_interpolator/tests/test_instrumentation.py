@@ -0,0 +1,115 @@
+import logging
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from grib_interpolator.base import Interpolator
+from grib_interpolator.instrumentation import (Instrumentation, LoggingInstrumentation, Metrics,
+                                               MultipleInstrumentation, logger)
+from grib_interpolator.intertables import intertables_cache
+from grib_interpolator.scipylib import clear_trees
+from grib_interpolator.synthetic import regular_grid
+from grib_interpolator.utils import progress_step_and_backchar
+
+
+class Events(Instrumentation):
+
+    def __init__(self):
+        self.events = []
+
+    def phase_started(self, phase, **info):
+        self.events.append(('start', phase))
+
+    def phase_ended(self, phase, seconds, **info):
+        self.events.append(('end', phase))
+
+    def progress(self, phase, done, total):
+        self.events.append(('progress', phase, done, total))
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.grid = regular_grid(60., 30., 31, -10., 30., 41)
+        random = np.random.RandomState(0)
+        cls.target_lats = random.uniform(25, 59, (15, 20))
+        cls.target_lons = random.uniform(-9, 29, (15, 20))
+        cls.values = random.normal(280, 5, cls.grid.lats.size)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        intertables_cache.clear()
+        clear_trees()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        intertables_cache.clear()
+        clear_trees()
+
+    def _interpolate(self, method, mode, instrumentation):
+        interpolator = Interpolator(self.grid.lats, self.grid.lons, self.grid, method=method, mode=mode,
+                                    store=self.tmp_dir, instrumentation=instrumentation)
+        interpolator.interpolate(self.values, self.target_lons, self.target_lats)
+        return interpolator
+
+    def test_phases(self):
+        metrics = Metrics()
+        interpolator = self._interpolate('analytic', 'invdist', metrics)
+        self.assertEqual(list(metrics.phases), ['transform', 'query', 'weights', 'apply', 'save'])
+        # target points south of 30N are out of grid
+        outs = np.count_nonzero(self.target_lats < 30)
+        self.assertEqual(metrics.phases['query']['outs'], outs)
+        self.assertEqual(metrics.phases['save']['points'], self.target_lats.size - outs)
+
+        intertables_cache.clear()
+        metrics.reset()
+        interpolator.interpolate(self.values, self.target_lons, self.target_lats)
+        interpolator.interpolate(self.values, self.target_lons, self.target_lats)
+        self.assertEqual(metrics.phases['load']['calls'], 1)
+        self.assertEqual(metrics.phases['apply']['calls'], 2)
+
+    def test_scipy_phases(self):
+        events = Events()
+        self._interpolate('scipy', 'nearest', events)
+        self.assertEqual(events.events[:4], [('start', 'transform'), ('end', 'transform'),
+                                             ('start', 'tree_build'), ('end', 'tree_build')])
+        self.assertIn(('progress', 'query', self.target_lats.size, self.target_lats.size), events.events)
+
+    def test_multiple(self):
+        metrics, events = Metrics(), Events()
+        self._interpolate('analytic', 'nearest', MultipleInstrumentation(metrics, events))
+        phase_events = [event for event in events.events if event[0] != 'progress']
+        self.assertEqual(len(phase_events), 2 * len(metrics.phases))
+
+    def test_logging(self):
+        handler = ListHandler()
+        logger.addHandler(handler)
+        try:
+            instrumentation = LoggingInstrumentation()
+            # nothing is logged below the logger level
+            logger.setLevel(logging.WARNING)
+            self._interpolate('analytic', 'nearest', instrumentation)
+            self.assertEqual(handler.messages, [])
+            logger.setLevel(logging.DEBUG)
+            instrumentation.progress('query', 5, 10)
+            self.assertEqual(handler.messages, ['query: 5/10 (50.00%)'])
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(logging.NOTSET)
+
+    def test_progress_step(self):
+        self.assertEqual(progress_step_and_backchar(10)[1], 1)
+        self.assertEqual(progress_step_and_backchar(1000)[1], 4)
@@ -27,6 +27,31 @@ class TestReader(unittest.TestCase):
         self.assertEqual(lat.shape, (21489, ))
         self.assertEqual(messages.grid_details.get('Nj'), 135)
 
+    def test_iter_messages(self):
+        args = {'shortName': '2t', 'perturbationNumber': 10}
+        messages = self.reader.select_messages(**args)
+        expected = messages.first_resolution_values()
+        reader = GRIBReader(self.input_file, indexes=['shortName', 'perturbationNumber'])
+        steps = []
+        for step, values in reader.iter_messages(**args):
+            np.testing.assert_array_equal(values, expected[step])
+            steps.append(step)
+        self.assertEqual(steps, expected.keys())
+        self.assertEqual(reader.grid_details.grid_id, messages.grid_id)
+        reader.close()
+
+    def test_select_groups(self):
+        messages = self.reader.select_messages(shortName='2t', perturbationNumber=10)
+        reader = GRIBReader(self.input_file, indexes=['shortName', 'perturbationNumber'])
+        groups = reader.select_groups(shortName='2t', perturbationNumber=[8, 10])
+        self.assertEqual([key[:2] for key in groups], [('2t', 8), ('2t', 10)])
+        group = groups.values()[1]
+        self.assertEqual(len(group), len(messages))
+        self.assertIs(groups.values()[0].grid_details, group.grid_details)
+        for step, values in messages.first_resolution_values().iteritems():
+            np.testing.assert_array_equal(group.first_resolution_values()[step], values)
+        reader.close()
+
 
 class TestInterpolator(unittest.TestCase):
 
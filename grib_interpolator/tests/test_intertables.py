@@ -0,0 +1,222 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from grib_interpolator import intertables
+from grib_interpolator.intertables import (IntertablesCache, Intertable, save_intertable, load_intertable,
+                                            read_header, load_legacy_intertable, IntertablesStore)
+from grib_interpolator.utils import grid_fingerprint
+
+
+def make_intertable(nnear=4, target_shape=(3, 4), n_source=20):
+    positions = np.array([0, 2, 3, 5, 7, 11], dtype=np.int32)
+    indexes = np.arange(positions.size * nnear, dtype=np.int32).reshape(-1, nnear) % n_source
+    weights = np.ones((positions.size, nnear), dtype=np.float32) / nnear
+    return Intertable('scipy_invdist', nnear, '0$359$4$3$12$regular_ll', target_shape,
+                      positions, indexes, weights, n_source=n_source)
+
+
+class TestIntertablesCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _save(self, name, size):
+        path = os.path.join(self.tmp_dir, name)
+        np.save(path, np.arange(size, dtype=np.int64))
+        return path
+
+    def test_hits_and_misses(self):
+        cache = IntertablesCache()
+        path = self._save('a.npy', 10)
+        first = cache.get(path)
+        second = cache.get(path)
+        self.assertIs(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        cache = IntertablesCache(max_bytes=160)
+        path_a = self._save('a.npy', 10)
+        path_b = self._save('b.npy', 10)
+        path_c = self._save('c.npy', 10)
+        cache.get(path_a)
+        cache.get(path_b)
+        cache.get(path_a)
+        cache.get(path_c)  # evicts b, least recently used
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache), 2)
+        cache.get(path_a)
+        self.assertEqual(cache.hits, 2)
+        cache.get(path_b)
+        self.assertEqual(cache.misses, 4)
+
+    def test_rewritten_file_is_reloaded(self):
+        cache = IntertablesCache()
+        path = self._save('a.npy', 10)
+        cache.get(path)
+        path = self._save('a.npy', 20)
+        self.assertEqual(cache.get(path).size, 20)
+        self.assertEqual(cache.misses, 2)
+        # entry of the previous file is dropped
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats()['bytes'], 20 * 8)
+        self.assertEqual(cache.evictions, 0)
+
+    def test_derived_arrays_are_charged(self):
+        cache = IntertablesCache()
+        intertable = make_intertable()
+        path = os.path.join(self.tmp_dir, 'table.itab')
+        save_intertable(path, intertable)
+        cache.put(path, intertable)
+        inserted = cache.stats()['bytes']
+        self.assertEqual(inserted, intertable.nbytes)
+        # float64 values: masks, float32 matrix and its float64 copy are built
+        intertable.apply(np.ones(20), -1)
+        self.assertGreater(cache.stats()['bytes'], inserted)
+        self.assertEqual(cache.stats()['bytes'], intertable.nbytes)
+        matrix = intertable._typed_matrix(np.ones(20))
+        self.assertEqual(matrix.dtype, np.float64)
+        self.assertTrue(np.may_share_memory(matrix.indices, intertable.indexes))
+        # table grown beyond the budget is evicted
+        cache = IntertablesCache(max_bytes=inserted)
+        intertable = make_intertable()
+        cache.put(path, intertable)
+        self.assertEqual(len(cache), 1)
+        intertable.apply(np.ones(20), -1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['bytes'], 0)
+        self.assertEqual(cache.evictions, 1)
+
+
+class TestIntertableFormat(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'table.itab')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_roundtrip(self):
+        intertable = make_intertable()
+        save_intertable(self.path, intertable)
+        header = read_header(self.path)
+        self.assertEqual(header['method'], 'scipy_invdist')
+        self.assertEqual(header['nnear'], 4)
+        self.assertEqual(header['target_shape'], [3, 4])
+        loaded = load_intertable(self.path)
+        self.assertIsInstance(loaded.indexes, np.memmap)
+        self.assertEqual(loaded.indexes.dtype, np.int32)
+        self.assertEqual(loaded.weights.dtype, np.float32)
+        values = np.arange(20, dtype=np.float64)
+        np.testing.assert_array_equal(loaded.apply(values, -1), intertable.apply(values, -1))
+
+    def test_apply(self):
+        intertable = make_intertable(nnear=1)
+        values = np.arange(20, dtype=np.float64) * 10
+        result = intertable.apply(values, -1)
+        self.assertEqual(result.shape, (3, 4))
+        self.assertEqual(result.flat[2], 10)
+        self.assertEqual(result.flat[1], -1)
+
+    def test_matrix(self):
+        intertable = make_intertable()
+        matrix = intertable.matrix
+        self.assertEqual(matrix.shape, (12, 20))
+        row_sizes = np.diff(matrix.indptr)
+        self.assertEqual(row_sizes[1], 0)
+        self.assertEqual(row_sizes[2], 4)
+
+    def test_apply_many(self):
+        intertable = make_intertable()
+        stack = np.random.RandomState(1).rand(5, 20)
+        result = intertable.apply_many(stack, -1)
+        self.assertEqual(result.shape, (5, 3, 4))
+        for i in range(5):
+            np.testing.assert_array_equal(result[i], intertable.apply(stack[i], -1))
+
+    def test_apply_out(self):
+        intertable = make_intertable()
+        stack = np.random.RandomState(1).rand(5, 20)
+        out = np.empty((5, 3, 4))
+        result = intertable.apply_many(stack, -1, out=out)
+        self.assertIs(result, out)
+        np.testing.assert_array_equal(out, intertable.apply_many(stack, -1))
+        out = np.empty((3, 4), dtype=np.float32)
+        intertable.apply(stack[0], -1, out=out)
+        np.testing.assert_allclose(out, intertable.apply(stack[0], -1), rtol=1e-6)
+        # non contiguous output
+        out = np.empty((4, 3)).T
+        intertable.apply(stack[0], -1, out=out)
+        np.testing.assert_array_equal(out, intertable.apply(stack[0], -1))
+
+    def test_apply_out_fallback(self):
+        intertable = make_intertable()
+        stack = np.random.RandomState(1).rand(5, 20)
+        expected = intertable.apply_many(stack, -1)
+        saved = intertables.csr_matvec
+
+        def incompatible_csr_matvec(*args):
+            raise TypeError('incompatible signature')
+
+        try:
+            for csr_matvec in (None, incompatible_csr_matvec):
+                intertables.csr_matvec = csr_matvec
+                out = np.empty((5, 3, 4))
+                intertable.apply_many(stack, -1, out=out)
+                np.testing.assert_allclose(out, expected, rtol=1e-15)
+        finally:
+            intertables.csr_matvec = saved
+
+    def test_legacy_scipy_invdist(self):
+        n_source = 20
+        indexes = np.array([[0, 1, 2, 3], [n_source] * 4, [4, 5, 6, 7]])
+        coeffs = np.array([[.25, .25, .25, .25], [1., 0., 0., 0.], [1., 0., 0., 0.]])
+        np.save(os.path.join(self.tmp_dir, 'legacy.npy'), np.rec.fromarrays((indexes, coeffs), names=('indexes', 'coeffs')))
+        intertable = load_legacy_intertable(os.path.join(self.tmp_dir, 'legacy.npy'), 'scipy_invdist', 'id', (3,), n_source)
+        result = intertable.apply(np.arange(n_source, dtype=np.float64), -1)
+        np.testing.assert_array_equal(result, [1.5, -1, 4])
+
+    def test_legacy_grib_invdist(self):
+        indexes = np.asarray([[0, 1], [1, 0], [0, 4], [1, 5], [2, 6], [3, 7]], dtype=np.int32)
+        coeffs = np.asarray([[.25, 1.], [.25, 0.], [.25, 0.], [.25, 0.], [0., 0.], [0., 0.]])
+        np.save(os.path.join(self.tmp_dir, 'legacy.npy'), np.rec.fromarrays((indexes, coeffs), names=('indexes', 'coeffs')))
+        intertable = load_legacy_intertable(os.path.join(self.tmp_dir, 'legacy.npy'), 'grib_invdist', 'id', (2, 2), 8)
+        result = intertable.apply(np.arange(8, dtype=np.float64), -1)
+        np.testing.assert_array_equal(result, [[-1, 1.5], [4, -1]])
+        # target points out of given target shape
+        self.assertRaises(ValueError, load_legacy_intertable, os.path.join(self.tmp_dir, 'legacy.npy'),
+                          'grib_invdist', 'id', (2, 1), 8)
+        self.assertRaises(ValueError, load_legacy_intertable, os.path.join(self.tmp_dir, 'legacy.npy'),
+                          'grib_invdist', 'id', (4,), 8)
+
+
+class TestIntertablesStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = IntertablesStore(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fingerprint(self):
+        lats, lons = np.meshgrid(np.linspace(30, 70, 50), np.linspace(-20, 40, 60))
+        self.assertEqual(grid_fingerprint(lats, lons), grid_fingerprint(lats.copy(), lons.copy()))
+        self.assertNotEqual(grid_fingerprint(lats, lons), grid_fingerprint(lats, lons + 0.01))
+        self.assertNotEqual(grid_fingerprint(lats, lons), grid_fingerprint(lats.T, lons.T))
+
+    def test_check(self):
+        intertable = make_intertable()
+        intertable.source_fingerprint = 'a' * 40
+        intertable.target_fingerprint = 'b' * 40
+        path = self.store.path_for(intertable.method, intertable.grid_id, 'a' * 40, 'b' * 40)
+        save_intertable(path, intertable)
+        self.store.check(path, intertable.method, 'a' * 40, 'b' * 40)
+        self.assertRaises(ValueError, self.store.check, path, intertable.method, 'a' * 40, 'c' * 40)
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from grib_interpolator.models import Step
+from grib_interpolator.pipeline import Pipeline, NpyWriter
+
+
+class GridDetails(object):
+
+    def __init__(self, nj, grid2=None):
+        self.num_points_along_meridian = nj
+        self.grid2 = grid2
+
+    def get_2nd_resolution(self):
+        return self.grid2
+
+
+class FakeInterpolator(object):
+    # stand-in for Interpolator: result is source values times factor
+
+    def __init__(self, nj, factor=1, delay=0.):
+        self.grid_details = GridDetails(nj)
+        self.factor = factor
+        self.delay = delay
+        # number of live threads at each call
+        self.threads = []
+
+    def interpolate(self, source_values, target_lons, target_lats):
+        self.threads.append(threading.active_count())
+        time.sleep(self.delay)
+        return np.ma.masked_array(source_values * self.factor)
+
+
+def messages(num, nj=3, delay=0.):
+    for i in xrange(num):
+        time.sleep(delay)
+        yield Step(i * 6, i * 6, nj, 6), np.full(nj, i, dtype=np.float64)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_order_and_results(self):
+        written = []
+        pipeline = Pipeline(FakeInterpolator(3, factor=2), None, None,
+                            writer=lambda step, result: written.append((step.end_step, result[0])), queue_size=2)
+        self.assertEqual(pipeline.run(messages(10)), 10)
+        self.assertEqual(written, [(i * 6, i * 2) for i in xrange(10)])
+
+    def test_second_resolution(self):
+        written = {}
+        pipeline = Pipeline(FakeInterpolator(3), None, None, writer=lambda step, result: written.update({step: result}),
+                            interpolator_2nd=FakeInterpolator(5, factor=10))
+        stream = list(messages(2)) + list(messages(2, nj=5))
+        self.assertRaises(ValueError, pipeline.run, stream)
+        self.assertRaises(ValueError, pipeline.prepare, np.zeros(3))
+        pipeline.prepare(np.zeros(3), np.zeros(5))
+        pipeline.run(stream)
+        self.assertEqual(sorted(result[0] for result in written.values()), [0, 0, 1, 10])
+        interpolator = FakeInterpolator(3)
+        interpolator.grid_details.grid2 = GridDetails(5)
+        self.assertRaises(ValueError, Pipeline(interpolator, None, None, writer=lambda step, result: None).run, stream)
+
+    def test_overlap(self):
+        # stages of 0.05s each: total time is close to the time of one stage
+        pipeline = Pipeline(FakeInterpolator(3, delay=.05), None, None,
+                            writer=lambda step, result: time.sleep(.05))
+        started = time.time()
+        pipeline.run(messages(10, delay=.05))
+        self.assertLess(time.time() - started, 1.)
+
+    def test_errors_are_raised(self):
+        def writer(step, result):
+            raise IOError('disk full')
+        pipeline = Pipeline(FakeInterpolator(3), None, None, writer=writer, queue_size=1)
+        self.assertRaises(IOError, pipeline.run, messages(20))
+
+    def test_npy_writer(self):
+        Pipeline(FakeInterpolator(3), None, None, writer=NpyWriter(self.tmp_dir, '2t')).run(messages(2))
+        np.testing.assert_array_equal(np.load(os.path.join(self.tmp_dir, '6_6_2t.npy')), [1, 1, 1])
+
+    def test_no_builds_with_threads(self):
+        threads = threading.active_count()
+        interpolator = FakeInterpolator(3)
+        written = []
+        Pipeline(interpolator, None, None, writer=lambda step, result: written.append(step.end_step)).run(messages(5))
+        self.assertEqual(written, [0, 6, 12, 18, 24])
+        # first message is interpolated before starting decoder and writer threads
+        self.assertEqual(interpolator.threads[0], threads)
+        interpolator = FakeInterpolator(3)
+        pipeline = Pipeline(interpolator, None, None, writer=lambda step, result: None)
+        pipeline.prepare(np.zeros(3))
+        self.assertEqual(pipeline.run(messages(5)), 5)
+        self.assertEqual(interpolator.threads[0], threads)
@@ -0,0 +1,221 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numexpr as ne
+import numpy as np
+
+from grib_interpolator.instrumentation import Metrics
+from grib_interpolator.models import TargetGrid
+from grib_interpolator.scipylib import InverseDistance, clear_trees, KDTREE_EXTENSION
+from grib_interpolator.synthetic import regular_grid, rotate_to_geographic
+from grib_interpolator.utils import tiles
+
+
+class TestKDTreeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        clear_trees()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        clear_trees()
+
+    def _full_bound(self, interpolator, grid):
+        # bound computed by querying nearest neighbours of all source points
+        x, y, z = interpolator.to_3d(grid.lons, grid.lats)
+        distances, _ = interpolator.tree.query(np.vstack((x, y, z)).T, k=2)
+        return np.max(distances) + np.max(distances) * 4 / grid.get('Nj')
+
+    def test_bound(self):
+        for grid in (regular_grid(90., -90., 91, 0., 356., 90), regular_grid(70., 30., 41, -10., 40., 51),
+                     regular_grid(70., 30., 41, -10., 40., 51, grid_type='reduced_ll')):
+            clear_trees()
+            interpolator = InverseDistance(grid.lons, grid.lats, grid, 1, -1, -1)
+            self.assertAlmostEqual(interpolator.min_upper_bound / self._full_bound(interpolator, grid), 1)
+
+    def test_shared_and_persisted(self):
+        grid = regular_grid(70., 30., 41, -10., 40., 51)
+        nearest = InverseDistance(grid.lons, grid.lats, grid, 1, -1, -1, store=self.tmp_dir)
+        invdist = InverseDistance(grid.lons, grid.lats, grid, 4, -1, -1, store=self.tmp_dir)
+        self.assertIs(nearest.tree, invdist.tree)
+        files = [f for f in os.listdir(self.tmp_dir) if f.endswith(KDTREE_EXTENSION)]
+        self.assertEqual(len(files), 1)
+        clear_trees()
+        loaded = InverseDistance(grid.lons, grid.lats, grid, 4, -1, -1, store=self.tmp_dir)
+        self.assertIsNot(loaded.tree, invdist.tree)
+        self.assertEqual(loaded.min_upper_bound, invdist.min_upper_bound)
+        np.testing.assert_array_equal(loaded.tree.data, invdist.tree.data)
+
+
+class TestPruneSource(unittest.TestCase):
+
+    def setUp(self):
+        clear_trees()
+
+    def tearDown(self):
+        clear_trees()
+
+    def test_same_results(self):
+        grid = regular_grid(90., -90., 181, 0., 358., 180)
+        values = np.random.RandomState(0).rand(grid.lats.size)
+        target_lons, target_lats = np.meshgrid(np.linspace(-10, 30, 40), np.linspace(65, 35, 30))
+        for nnear in (1, 4):
+            full = InverseDistance(grid.lons, grid.lats, grid, nnear, -1, -1)
+            pruned = InverseDistance(grid.lons, grid.lats, grid, nnear, -1, -1, prune_source=True)
+            for expected, result in zip(full.interpolate(values, target_lons, target_lats),
+                                        pruned.interpolate(values, target_lons, target_lats)):
+                np.testing.assert_array_equal(result, expected)
+            self.assertLess(pruned.tree.n, full.tree.n / 10)
+
+    def test_global_target(self):
+        grid = regular_grid(90., -90., 91, 0., 356., 90)
+        target_lons, target_lats = np.meshgrid(np.linspace(-180, 179, 36), np.linspace(89, -89, 18))
+        pruned = InverseDistance(grid.lons, grid.lats, grid, 1, -1, -1, prune_source=True)
+        pruned.interpolate(np.zeros(grid.lats.size), target_lons, target_lats)
+        self.assertIsNone(pruned.source_indexes)
+        self.assertEqual(pruned.tree.n, grid.lats.size)
+
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def setUp(self):
+        clear_trees()
+
+    def tearDown(self):
+        clear_trees()
+
+    def test_tiles(self):
+        grid = regular_grid(70., 30., 41, -10., 40., 51)
+        random = np.random.RandomState(0)
+        target_lats = random.uniform(20, 80, (50, 70))
+        target_lons = random.uniform(-20, 50, (50, 70))
+        target_lons[0, :10] = -1.0e+20
+        values = random.rand(grid.lats.size)
+        for nnear in (1, 4):
+            metrics = Metrics()
+            whole = InverseDistance(grid.lons, grid.lats, grid, nnear, -1, -1)
+            # tiles of 1000 points
+            tiled = InverseDistance(grid.lons, grid.lats, grid, nnear, -1, -1, memory_budget=1, instrumentation=metrics)
+            expected = whole.table(target_lons, target_lats)
+            table = tiled.table(target_lons, target_lats)
+            self.assertEqual(metrics.phases['query']['calls'], 4)
+            for expected_array, array in zip(expected, table):
+                np.testing.assert_array_equal(array, expected_array)
+            self.assertEqual(table[1].dtype, np.int32)
+            self.assertEqual(table[2].dtype, np.float32)
+            self.assertGreaterEqual(table[0][0], 10)
+            for expected_array, array in zip(whole.interpolate(values, target_lons, target_lats),
+                                             tiled.interpolate(values, target_lons, target_lats)):
+                np.testing.assert_array_equal(array, expected_array)
+
+    def test_tile_bounds(self):
+        self.assertEqual(tiles(2500, None, 100), [(0, 2500)])
+        self.assertEqual(tiles(2500, 100000, 100), [(0, 1000), (1000, 2000), (2000, 2500)])
+        self.assertEqual(tiles(0, 100000, 100), [])
+
+
+class TestTargetGrid(unittest.TestCase):
+
+    def setUp(self):
+        clear_trees()
+
+    def tearDown(self):
+        clear_trees()
+
+    def test_shared(self):
+        grid = regular_grid(70., 30., 41, -10., 40., 51)
+        random = np.random.RandomState(0)
+        target_lats = random.uniform(20, 80, (30, 40))
+        target_lons = random.uniform(-20, 50, (30, 40))
+        target_lons[0, :10] = -1.0e+20
+        target = TargetGrid(target_lats, target_lons)
+        for nnear in (1, 4):
+            interpolator = InverseDistance(grid.lons, grid.lats, grid, nnear, -1, -1, memory_budget=1)
+            expected = interpolator.table(target_lons, target_lats)
+            for expected_array, array in zip(expected, interpolator.table(target)):
+                np.testing.assert_array_equal(array, expected_array)
+        # Cartesian coordinates are computed once for both interpolators
+        self.assertEqual(len(target._transformed), 1)
+
+    def test_rotated_target(self):
+        south_pole_lat, south_pole_lon = -40., 10.
+        grid = regular_grid(-5., 5., 11, -5., 5., 11, grid_type='rotated_ll',
+                            latitudeOfSouthernPoleInDegrees=south_pole_lat,
+                            longitudeOfSouthernPoleInDegrees=south_pole_lon)
+        lats, lons = rotate_to_geographic(grid.lats, grid.lons, south_pole_lat, south_pole_lon)
+        random = np.random.RandomState(0)
+        rotated_lats = random.uniform(-4.5, 4.5, (10, 12))
+        rotated_lons = random.uniform(-4.5, 4.5, (10, 12))
+        target_lats, target_lons = rotate_to_geographic(rotated_lats, rotated_lons, south_pole_lat, south_pole_lon)
+        expected = InverseDistance(lons, lats, grid, 4, -1, -1).table(target_lons, target_lats)
+        table = InverseDistance(lons, lats, grid, 4, -1, -1, rotated_target=True).table(
+            TargetGrid(rotated_lats, rotated_lons))
+        np.testing.assert_array_equal(table[0], np.arange(120))
+        np.testing.assert_array_equal(table[1], expected[1])
+        np.testing.assert_allclose(table[2], expected[2], rtol=1e-5)
+
+
+class TestWeights(unittest.TestCase):
+    # vectorized weights against the per-row implementation they replaced
+
+    def setUp(self):
+        clear_trees()
+        grid = regular_grid(70., 30., 41, -10., 40., 51)
+        self.interpolator = InverseDistance(grid.lons, grid.lats, grid, 4, -1, -1)
+        self.interpolator.min_upper_bound = 0.8
+        random = np.random.RandomState(0)
+        self.z = random.normal(280, 5, grid.lats.size)
+        self.distances = np.sort(random.uniform(0, 1, (20000, 4)), axis=1)
+        # exact hits
+        self.distances[::7, 0] = 0.
+        self.indexes = random.randint(0, self.z.size, (20000, 4))
+
+    def tearDown(self):
+        clear_trees()
+
+    def _reference(self, nnear):
+        z, n_source, bound = self.z, self.z.size, self.interpolator.min_upper_bound
+        result = np.empty(len(self.distances))
+        weights = np.empty((len(self.distances), nnear))
+        idxs = np.empty((len(self.distances), nnear), dtype=int)
+        idxs.fill(n_source)
+        outs = 0
+        for i, (dist, ix) in enumerate(zip(self.distances[:, :nnear], self.indexes[:, :nnear])):
+            weights[i] = (1., 0., 0., 0.)[:nnear]
+            if nnear > 1 and dist[0] <= 1e-10:
+                result[i] = z[ix[0]]
+                idxs[i] = ix
+            elif dist[0] <= bound:
+                w = ne.evaluate('1 / dist ** 2')
+                sums = ne.evaluate('sum(w)')
+                ne.evaluate('w / sums', out=w)
+                result[i] = np.dot(w, z[ix]) if nnear > 1 else z[ix[0]]
+                if nnear > 1:
+                    weights[i] = w
+                idxs[i] = ix
+            else:
+                outs += 1
+                result[i] = -1
+        return result, weights, idxs, outs
+
+    def test_invdist(self):
+        result, weights, idxs, outs = self.interpolator._build_weights(self.z, self.distances, self.indexes, 4)
+        expected = self._reference(4)
+        self.assertGreater(expected[3], 0)
+        # weights and indexes (saved in intertables) are the same bit for bit;
+        # np.dot of the reference sums products in BLAS order, so results may differ in the last bit
+        np.testing.assert_allclose(result, expected[0], rtol=1e-15, atol=0)
+        np.testing.assert_array_equal(result == -1, expected[0] == -1)
+        np.testing.assert_array_equal(weights, expected[1])
+        np.testing.assert_array_equal(idxs, expected[2])
+        self.assertEqual(outs, expected[3])
+
+    def test_nearest(self):
+        result, idxs, outs = self.interpolator._build_nn(self.z, self.distances[:, 0], self.indexes[:, 0])
+        expected = self._reference(1)
+        np.testing.assert_array_equal(result, expected[0])
+        np.testing.assert_array_equal(idxs, expected[2][:, 0])
+        self.assertEqual(outs, expected[3])
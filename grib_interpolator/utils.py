@@ -3,9 +3,11 @@ This software comes as Open Source and licensed via AGPL v3.
 It was developed under the initiative Copernicus, EFAS operational center @ECMWF (Reading, UK).
 """
 
-import numpy as np
+import hashlib
 from datetime import datetime
 
+import numpy as np
+
 int_fill_value = -999999
 
 
@@ -37,8 +39,75 @@ def now_string(fmt='%Y-%m-%d %H:%M'):
     return datetime.strftime(datetime.now(), fmt)
 
 
+def valid_coordinates(lons, mv):
+    # points with coordinates: not mv, nor fill values (< -1e10) or NaN
+    return (lons > -1.0e+10) & (lons != mv) & np.isfinite(lons)
+
+
 def progress_step_and_backchar(num_cells):
-    progress_step = num_cells / 250
+    # at least 1, so it can be used as modulo for small grids
+    progress_step = max(1, num_cells // 250)
     back_char = '\r'
     return back_char, progress_step
 
+
+def tiles(num_points, memory_budget, bytes_per_point, min_tile=1000):
+    """
+    Bounds [start, stop) of tiles of target points processed at once,
+    sized so that temporaries of a tile (bytes_per_point each point) fit in memory_budget bytes.
+    Without memory_budget, all points are processed at once.
+    """
+    size = max(min_tile, int(memory_budget // bytes_per_point)) if memory_budget else max(num_points, 1)
+    return [(start, min(start + size, num_points)) for start in xrange(0, num_points, size)]
+
+
+def shrink(array, num_rows):
+    # first num_rows rows of a preallocated array, releasing the memory of the others.
+    # Array must own its data and have no views.
+    array.resize((num_rows,) + array.shape[1:], refcheck=False)
+    return array
+
+
+def open_output_cube(path, num_fields, target_shape, dtype=np.float64):
+    """
+    Preallocates a (num_fields,) + target_shape array memory-mapped to a .npy file on disk.
+    Pass its slices as out argument of Interpolator.interpolate (or the whole cube to interpolate_many):
+    results are written in place, so cubes larger than memory can be produced.
+    """
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(num_fields,) + tuple(target_shape))
+
+
+def grid_fingerprint(lats, lons, num_samples=4096):
+    # fast fingerprint of a grid: shape plus a strided sample of coordinates,
+    # always including the last point
+    fingerprint = hashlib.sha1(str(np.shape(lats)).encode('utf-8'))
+    for coords in (lats, lons):
+        flat = np.ravel(coords)
+        stride = max(1, flat.size // num_samples)
+        sample = np.append(flat[::stride], flat[-1:])
+        fingerprint.update(np.ascontiguousarray(sample, dtype='<f8').tobytes())
+    return fingerprint.hexdigest()
+
+
+def source_statistics(stack, statistics):
+    """
+    Statistics of a stack of fields (e.g. ensemble members) of shape (n_fields, n_points), point by point.
+    statistics: sequence of 'mean', 'min', 'max', 'std', 'median',
+    ('quantile', q) with 0 <= q <= 1 and ('probability', threshold) for exceedance probability.
+    Returns an array of shape (len(statistics), n_points)
+    """
+    result = np.empty((len(statistics), stack.shape[1]), dtype=np.result_type(stack, np.float32))
+    quantiles = [(i, stat[1]) for i, stat in enumerate(statistics) if is_container(stat) and stat[0] == 'quantile']
+    if quantiles:
+        # all quantiles with a single sort
+        rows, qs = zip(*quantiles)
+        result[list(rows)] = np.percentile(stack, [q * 100 for q in qs], axis=0)
+    functions = {'mean': np.mean, 'min': np.min, 'max': np.max, 'std': np.std, 'median': np.median}
+    for i, stat in enumerate(statistics):
+        if stat in functions:
+            result[i] = functions[stat](stack, axis=0)
+        elif is_container(stat) and stat[0] == 'probability':
+            result[i] = np.count_nonzero(stack > stat[1], axis=0) / float(stack.shape[0])
+        elif not (is_container(stat) and stat[0] == 'quantile'):
+            raise ValueError('Unknown statistic {}'.format(stat))
+    return result
@@ -1,19 +1,25 @@
+import logging
 import os
 import numpy as np
 
 from grib_interpolator import Interpolator
 from grib_interpolator import GRIBReader
+from grib_interpolator import TargetGrid
+from grib_interpolator.pipeline import Pipeline, NpyWriter
 
 
 if __name__ == '__main__':
     current_dir = os.path.dirname(os.path.abspath(__file__))
+    # phases of intertable builds (timings, points, outs) are logged by 'grib_interpolator' logger
+    logging.basicConfig(level=logging.INFO)
 
     # shortName of variable to extract, as stored in GRIB messages
     variable = '2t'
 
     input_file = '/dataset/test_2013330702/EpsN320-2013063000.grb'
     print 'Opening {}'.format(input_file)
-    # Opening input file, using indexes if present in GRIB file
+    # Opening input file. Headers of all messages are read once in a table,
+    # indexes are keys to store in it besides the default ones (see headers.HEADER_KEYS)
     reader = GRIBReader(input_file, indexes=('shortName', 'perturbationNumber'))
     # you can filter messages with any key,
     # as startStep, endStep and so on. Filters can also be lists of values to select
@@ -23,52 +29,54 @@ if __name__ == '__main__':
     # Filters can also be functions (very useful to select messages between a range)
     start_step = lambda s: s >= 6
     end_step = lambda s: s <= 120
-    messages = reader.select_messages(shortName=variable, perturbationNumber=10,
-                                      startStep=start_step, endStep=end_step)
-
-    # get coordinates from GRIB
-    lats, lons = messages.latlons
+    # messages are decoded one at a time while iterating
+    messages = reader.iter_messages(shortName=variable, perturbationNumber=10,
+                                    startStep=start_step, endStep=end_step)
 
     # grid_details is a GridDetails object with some geodetic metadata
     # describing grid, used in interpolation
-    grid_details = messages.grid_details
+    grid_details = reader.grid_details
+    # get coordinates from GRIB
+    lats, lons = grid_details.latlons
 
     # we need these gids (GRIB message ids) from reader because
     # they are required from GRIB API 'find nearest' methods.
     aux_g, aux_v, aux_g2, aux_v2 = reader.get_gids_for_intertable()
 
     # Intertables will be saved/loaded using this folder.
-    # The intertable is a numpy binary file with indexes and weights that will be reused
-    # for future interpolations
-    # Important Note: Use one folder per target grid,
-    # otherwise intertables will be overwritten as file naming is
-    # based only on source grid metadata.
-    store = '/dataset/interpolator_intertables/europe_5km'
+    # The intertable is a binary file with indexes and weights that will be reused
+    # for future interpolations.
+    # File naming is based on fingerprints of both source and target grids,
+    # so the same folder can be shared by all target grids.
+    store = '/dataset/interpolator_intertables'
 
     # Loading target grid. In this example, files are pickled numpy arrays
     # representing Europe grid 5Km
     target_lats = np.load(current_dir + '/grib_interpolator/tests/target_lats.npy')
     target_lons = np.load(current_dir + '/grib_interpolator/tests/target_lons.npy')
+    # fingerprint and transformed coordinates of target grid are computed once
+    # and shared by all interpolators using it
+    target = TargetGrid(target_lats, target_lons)
 
     # mode can be 'nearest', 'invdist'. method can be 'grib' or 'scipy'
+    # with masked=False results are plain numpy arrays with NaN (or target_mv) out of source grid
     interpolator = Interpolator(source_lons=lons, source_lats=lats,
                                 source_grid_details=grid_details,
-                                gid=aux_g, mode='nearest', method='grib', store=store)
+                                gid=aux_g, mode='nearest', method='grib', store=store, masked=False)
 
     # Note: intertable creation can take from minutes to several hours or days,
     # depending on source and target sizes and from CPU speed.
     # Once intertable is created, the whole process
     # will last a few seconds
-    # In this example result will be saved as numpy binary files
-    print 'Intertable {} will be created if not existing yet'.format(interpolator.intertable_path)
-    for timestep, values in messages.first_resolution_values().iteritems():
-        print 'Interpolating timestep {}'.format(timestep)
-        out_file = '{}_{}_{}.npy'.format(timestep.start_step, timestep.end_step, variable)
-        out_file = os.path.join('/dataset/interpolator_tests/EpsN320', out_file)
-        interpolated_values = interpolator.interpolate(values, target_lons, target_lats)
-        print 'Saving result in numpy file {}'.format(out_file)
-        # result is a MaskedArray so we only save real array
-        np.save(out_file, interpolated_values.data)
+    # In this example results will be saved as numpy binary files.
+    # Next messages are decoded and previous results are written while interpolating
+    print 'Intertable {} will be created if not existing yet'.format(interpolator.get_intertable_path(target))
+    writer = NpyWriter('/dataset/interpolator_tests/EpsN320', variable)
+    pipeline = Pipeline(interpolator, target, None, writer)
+    # intertable is built (or loaded) here, before pipeline threads start
+    pipeline.prepare(aux_v)
+    print 'Interpolated {} messages'.format(pipeline.run(messages))
+    print 'Seconds spent in each stage: {}'.format(pipeline.timings)
     reader.close()
 
     ################################
@@ -83,12 +91,12 @@ if __name__ == '__main__':
     interpolator = Interpolator(source_lons=lons, source_lats=lats,
                                 source_grid_details=grid_details,
                                 mode='nearest', method='scipy',
-                                store='/dataset/interpolator_intertables/cosmo')
+                                store=store, masked=False)
 
     for timestep, values in messages.first_resolution_values().iteritems():
         print 'Interpolating timestep {}'.format(timestep)
         out_file = '{}_{}_{}.npy'.format(timestep.start_step, timestep.end_step, variable)
         out_file = os.path.join('/dataset/interpolator_tests/cosmo', out_file)
-        interpolated_values = interpolator.interpolate(values, target_lons, target_lats)
-        np.save(out_file, interpolated_values.data)
+        interpolated_values = interpolator.interpolate(values, target)
+        np.save(out_file, interpolated_values)
     reader.close()